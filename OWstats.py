@@ -1,14 +1,30 @@
+import collections
 import datetime
 import logging
+import os
+import signal
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from socket import gaierror
 
+import requests
 import urllib3
-
-from owstats import CompStats, Season, Player, db
-from owstats.utils import (check_if_more_than_seven_days, get_api_response,
-                           is_it_monday, is_it_new_season, make_plot)
+from sqlalchemy.exc import IntegrityError
+
+from owstats import CompStats, Season, Player, db, metrics
+from owstats.export import export_comp_stats, import_comp_stats
+from owstats.importer import import_players, parse_players
+from owstats.ingest import NOT_FOUND, PRIVATE, PUBLIC, parse_profile
+from owstats.plots import render_plots
+from owstats.rollups import rebuild_rollups
+from owstats.scheduler import PollScheduler
+from owstats.seasons import retag_seasons, roll_over_season
+from owstats.utils import (ApiError, CircuitBreaker, check_if_more_than_seven_days, fetch_profile,
+                           is_it_monday)
+from owstats.workqueue import WorkQueue
+from owstats.writer import StatsWriter
 
 logging.basicConfig(filename=f'OWstats-{datetime.datetime.now().strftime("%Y-%m")}.log',
                     level=logging.INFO,
@@ -18,24 +34,61 @@ logging.basicConfig(filename=f'OWstats-{datetime.datetime.now().strftime("%Y-%m"
 
 
 MINUTES_TO_SLEEP = 120
+MAX_WORKERS = int(os.environ.get('OWSTATS_WORKERS', 8))  # concurrent API requests per sweep
+POLL_BATCH = int(os.environ.get('OWSTATS_POLL_BATCH', 100))  # max players polled at once in -c mode
+FAILURE_BACKOFF = 60 * 15   # seconds before retrying a player that failed, doubled on every failure in a row
+MAX_FAILURE_BACKOFF = 60 * 60 * 24
+
+# what can go wrong with a single player, these don't stop the sweep
+PLAYER_ERRORS = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, gaierror,
+                 ApiError, KeyError, TypeError, ValueError)
 
 
 class OWstats:
     sleep_time = 60 * MINUTES_TO_SLEEP  # number of minutes to wait until the next run
     sleep_time_extended = False
+    current_season = None
+    scheduler = None
+    breaker = None      # kept for the whole run, not per sweep
+    stopping = None     # set by the daemon's signal handler
 
     def increase_sleep_time(self):
         self.sleep_time = self.sleep_time + 60 * 15
         self.sleep_time_extended = True
 
     def reset_sleep_time(self):
-        self.sleep_time = 60 * MINUTES_TO_SLEEP
+        if self.sleep_time_extended:
+            return      # backing off, the loop clears this after the sleep
+        if self.scheduler:
+            # sleep until the next player is due, but wake up now and then to see new players
+            self.sleep_time = min(max(self.scheduler.seconds_until_next(), 5), 60 * MINUTES_TO_SLEEP)
+        else:
+            self.sleep_time = 60 * MINUTES_TO_SLEEP
+
+    def poll_due_players(self):
+        if self.scheduler is None:
+            self.scheduler = PollScheduler()
+        self.scheduler.reload()
+        player_ids = self.scheduler.pop_due(POLL_BATCH)
+        if player_ids:
+            try:
+                self.log_stats_to_db(users=Player.query.filter(Player.id.in_(player_ids)).all())
+            finally:
+                self.scheduler.release(player_ids)
+                # the next batch starts with fresh player rows, not the ones loaded now
+                db.session.remove()
+        return len(player_ids)
 
     def set_season(self, season_no):
         new_season = Season()
         new_season.season = season_no
         db.session.add(new_season)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            print(f"Season {season_no} already exists.")
+            return
         print("Season set successfully.")
 
     def set_next(self, season_end):
@@ -49,197 +102,403 @@ class OWstats:
         current_season = Season.query.order_by(Season.etime.desc()).first()
         print(current_season)
 
-    def log_stats_to_db(self, all=False):
+    def render_plots(self, season=None):
+        if season is None:
+            season = Season.query.order_by(Season.etime.desc()).first().season
+        player_ids = db.session.query(CompStats.player_id).filter_by(season=season).distinct()
+        rendered = render_plots((player_id, season) for player_id, in player_ids)
+        print(f"Rendered {rendered} plots for season {season}.")
+
+    def rebuild_rollups(self):
+        count = rebuild_rollups()
+        print(f"Rolled up {count} rows.")
+
+    def retag_seasons(self):
+        moved, changed = retag_seasons()
+        if not moved:
+            print("All rows are in the right season.")
+            return
+        rebuild_rollups({player_id for player_id, _ in changed})
+        # their plots are out of date now, /chart renders them again when they're looked at
+        print(f"Moved {moved} rows to the season they were logged in "
+              f"and rebuilt the rollups of {len({player_id for player_id, _ in changed})} players.")
+
+    def export(self, out_dir):
+        count = export_comp_stats(out_dir)
+        print(f"Exported {count} rows to {out_dir}.")
+
+    def import_(self, in_dir):
+        count = import_comp_stats(in_dir)
+        print(f"Imported {count} rows from {in_dir}. Run 'OWstats rollups' to update the rollups.")
+
+    def add_players(self, path):
+        with open(path, encoding='utf-8-sig') as f:
+            rows = parse_players(f.read(), fmt='json' if path.endswith('.json') else 'csv')
+        results = import_players(rows)
+        for result in results:
+            print(f"{result['row']}: {result['platform']}/{result['region']}/{result['username']} "
+                  f"{result['status']} - {result['message']}")
+        added = sum(result['status'] == 'added' for result in results)
+        print(f"Added {added} of {len(results)} players.")
+
+    def log_stats_to_db(self, all=False, users=None):
         logging.info('DB stats call')
+        sweep_start = time.perf_counter()
+        self.sweep_results = collections.Counter()     # players by result, for the metrics
 
-        # What season is it?
-        current_season = Season.query.order_by(Season.etime.desc()).first()
+        # What season is it? Decided once, before any stats are logged
+        self.current_season = roll_over_season()
+        self.writer = StatsWriter()
+        self.new_stats = {}  # player id -> season, for players that got a new CompStats row
+        if self.breaker is None:
+            self.breaker = CircuitBreaker()
 
         # make list of users that need to be processed
-        users = Player.query.filter_by(active=1).order_by(Player.etime.desc()).all()
-        logging.info(f'users: {users}')
-
         # if it's the first run on Monday, check if any of inactive players played in the last week
-        if is_it_monday() or all:
-            users = users + Player.query.filter_by(active=2).all()    # inactive
-            users = users + Player.query.filter_by(active=3).all()    # private
-            users = users + Player.query.filter_by(active=0).all()    # error
-            
-
-        # get stats for active players
-        for user in users:
-            platform = user.platform
-            region = user.region
-            username = user.username
-
-            logging.info(f'processing: {platform}/{region}/{username}')       
-
+        if users is not None:
+            pass    # picked by the scheduler
+        elif is_it_monday() or all:
+            users = Player.query_by_status(1, 2, 3, 0).filter(Player.is_due()).all()    # active, inactive, private, error
+        else:
+            users = Player.query_by_status(1).filter(Player.is_due()).all()
+        logging.info(f'{len(users)} players to poll')
+
+        # when each player in this batch last got a new row, for the inactivity check
+        self.last_logged = dict(db.session.query(CompStats.player_id, db.func.max(CompStats.ctime))
+                                .filter(CompStats.player_id.in_([user.id for user in users]))
+                                .group_by(CompStats.player_id)) if users else {}
+
+        # Fetch stage: API calls run in a bounded thread pool, while all the DB work
+        # below stays on this thread, in the order the responses come back.
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(fetch_profile, user.platform, user.region, user.username,
+                                       user.api_etag, user.api_last_modified, user.api_hash): user
+                       for user in users}
             try:
-                response = get_api_response(platform, region, username)
-            except urllib3.exceptions.MaxRetryError:
-                logging.exception("MaxRetryError - Connection problems, let's wait for a while...")
-                self.increase_sleep_time()
+                stopped = False
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+                    user = futures[future]
+                    logging.info(f'processing: {user.platform}/{user.region}/{user.username}')
+
+                    # one bad profile or failed request only costs us that player
+                    try:
+                        self.process_profile(user, *future.result())
+                    except PLAYER_ERRORS:
+                        logging.exception(f'Failed to process {user.platform}/{user.region}/{user.username}')
+                        self.record_failure(user)
+                    else:
+                        self.record_success(user)
+
+                    if self.breaker.is_open():
+                        logging.error("Too many players failed, the API seems to be down. Let's wait for a while...")
+                        self.increase_sleep_time()
+                        self.breaker.reset()    # count afresh after the backoff
+                        return
+
+                    if self.stopping is not None and self.stopping.is_set() and not stopped:
+                        # finish the requests in flight, but don't start new ones
+                        logging.info('Stopping, finishing the players in flight')
+                        for pending in futures:
+                            pending.cancel()
+                        stopped = True
+
+                    if self.writer.is_full():
+                        self.write_pending()
+            finally:
+                # don't start any more requests if we bailed out early
+                for future in futures:
+                    future.cancel()
+                self.write_pending()
+                self.record_sweep(len(users), time.perf_counter() - sweep_start)
+
+    def process_profile(self, user, response, content_hash, changed):
+        response.raise_for_status()
+
+        if not changed:
+            # same profile as last time, no need to parse it or log anything
+            logging.info('Profile not changed.')
+            if user.active == 1:
+                self.mark_if_inactive(user)
+            return
+
+        logging.info('Request is successful.')
+        self.log_player_stats(user, parse_profile(response.json()))
+        self.writer.update_player(user,
+                                  api_etag=response.headers.get('ETag'),
+                                  api_last_modified=response.headers.get('Last-Modified'),
+                                  api_hash=content_hash)
+
+    def record_success(self, user):
+        self.breaker.record(True)
+        self.sweep_results['new_stats' if user.id in self.new_stats else 'unchanged'] += 1
+        if user.error_count:
+            self.writer.update_player(user, error_count=0)
+        if self.scheduler:
+            next_poll, interval = self.scheduler.reschedule(user, changed=user.id in self.new_stats)
+            self.writer.update_player(user, next_poll=next_poll, poll_interval=interval)
+
+    def record_failure(self, user):
+        self.breaker.record(False)
+        self.sweep_results['failed'] += 1
+        # back off exponentially from players that keep failing
+        error_count = (user.error_count or 0) + 1
+        backoff = min(FAILURE_BACKOFF * 2 ** (error_count - 1), MAX_FAILURE_BACKOFF)
+        next_poll = datetime.datetime.utcnow() + datetime.timedelta(seconds=backoff)
+        self.writer.update_player(user, error_count=error_count, next_poll=next_poll)
+        self.new_stats.pop(user.id, None)
+        if self.scheduler:
+            self.scheduler.push(user.id, next_poll)
+
+    def record_sweep(self, players, seconds):
+        # players we didn't get to, because the breaker stopped the sweep
+        self.sweep_results['skipped'] = players - sum(self.sweep_results.values())
+        for result in ('new_stats', 'unchanged', 'failed', 'skipped'):
+            metrics.sweep_players.inc(self.sweep_results[result], result=result)
+            metrics.last_sweep_players.set(self.sweep_results[result], result=result)
+        metrics.sweep_seconds.observe(seconds)
+        metrics.last_sweep_seconds.set(seconds)
+        metrics.last_sweep_timestamp.set(time.time())
+        logging.info(f'Sweep of {players} players took {seconds:.1f}s: {dict(self.sweep_results)}')
+        try:
+            metrics.push_metrics()
+        except requests.exceptions.RequestException:
+            logging.exception('Could not push metrics')
+
+    def write_pending(self):
+        # plots aren't rendered here, /chart renders them when someone looks at them
+        self.writer.flush()
+        self.new_stats.clear()
+
+    def log_player_stats(self, user, profile):
+        if profile.status != PUBLIC:
+            if profile.status == PRIVATE:
+                self.writer.update_player(user, active=3)
                 return
-            except gaierror:
-                logging.exception("gaierror - Connection problems, let's wait for a while...")
-                self.increase_sleep_time()
+            logging.error(f"Request error: {profile.error}")
+            if profile.status == NOT_FOUND:
+                self.writer.update_player(user, active=0)
                 return
+            raise ApiError(profile.error)
 
-            # Check the response
-            if response:
-                logging.info('Request is successful.')
-
-                try:
-                    # Get JSON from the response
-                    r_json = response.json()
-                    # print(r_json)
-
-                    if 'error' in r_json:
-                        logging.error(f"Request error: {r_json['error']}")
-                        if r_json['error'] == "Player not found":
-                            user.active = 0
-                            db.session.commit()
-                            continue
-                        else:
-                            logging.error(f"json.error: {r_json['error']}")
-                            continue
-                    
-                    if r_json['private']:
-                        user.active = 3
-                        db.session.commit()
-                        continue
+        if (profile.icon, profile.endorsement) != (user.icon, user.endorsement):
+            self.writer.change_profile(user, icon=profile.icon, endorsement=profile.endorsement)
 
-                    games_played = r_json['competitiveStats']['games']['played']
-
-                    if user.games_played != games_played:
-                        
-                        # if there are no placements at all, there is no need to log this
-                        if r_json['rating'] == 0:
-                            logging.info('No rating yet for this player.')
-                            continue
-
-                        # is it a new season for this user
-                        if games_played < user.games_played:
-
-                            # is it a new season for everyone?
-                            if is_it_new_season(current_season.next_switch_date):
-                                # it's a new season, so we're making a new one!
-                                new_season = Season()
-                                new_season.season = current_season.season + 1
-                                db.session.add(new_season)
-                                db.session.commit()
-                                current_season = new_season
-                                logging.info(f'New season created: {new_season}')
-
-                        cs = CompStats()
-
-                        cs.season = current_season.season
-                        cs.games_played = games_played
-                        cs.games_won = r_json['competitiveStats']['games']['won']
-                        cs.rating_avg = r_json['rating']
-                        if 'ratings' in r_json and r_json['ratings'] is not None:
-                            for rating in r_json['ratings']:
-                                if rating['role'] == 'tank':
-                                    cs.rating_tank = rating['level'] or None
-                                if rating['role'] == 'damage':
-                                    cs.rating_damage = rating['level'] or None
-                                if rating['role'] == 'support':
-                                    cs.rating_support = rating['level'] or None
-                        else:
-                            cs.rating_tank = None
-                            cs.rating_damage = None
-                            cs.rating_support = None
-                        
-                        cs.player = user
-
-                        db.session.add(cs)
-                        db.session.commit()
-
-                        user.games_played = games_played
-                        user.active = 1
-                        user.endorsement = r_json['endorsement']
-                        user.icon = r_json['icon']
-                        db.session.commit()
-
-                        make_plot(user)
-                        logging.info('Made plot')
-                    elif check_if_more_than_seven_days(user.comp_stats[0].ctime):
-                        user.active = 2     # inactive for a week or more
-                        db.session.commit()
-                        logging.info('User set to inactive')
-
-                except KeyError:
-                    print('\n\nKeyError - API mapping issue?')
-                    # logging.error('KeyError - API mapping issue?')
-                    logging.exception('KeyError - API mapping issue?')
-                    return           
+        stats = profile.stats(self.current_season.season)
+        if stats['content_hash'] == user.stats_hash:
+            self.mark_if_inactive(user)
+            return
 
+        # if there are no placements at all, there is no need to log this
+        if profile.rating_avg == 0:
+            logging.info('No rating yet for this player.')
+            return
 
+        # a new snapshot for new games, but also for ratings corrected after the fact
+        self.writer.add_stats(user, **stats)
+        if profile.games_played != user.games_played:
+            self.writer.update_player(user, active=1)
+        self.writer.update_player(user, games_played=profile.games_played, stats_hash=stats['content_hash'])
+        self.new_stats[user.id] = self.current_season.season
 
-# Main loop goes here
-def main():
-    ow_stats = OWstats()
-    while True:
-        logging.info('Going for another run')
-        try:
-            if len(sys.argv) > 1:
-                if len(sys.argv) == 3 and sys.argv[1] == 'set-season':
-                    ow_stats.set_season(int(sys.argv[2]))
-                    return
+    def mark_if_inactive(self, user):
+        last_logged = self.last_logged.get(user.id)
+        if last_logged and check_if_more_than_seven_days(last_logged):
+            self.writer.update_player(user, active=2)     # inactive for a week or more
+            logging.info('User set to inactive')
+
+
+
+def run_command(ow_stats, argv):
+    """Runs one of the one-off commands, returns False if argv isn't one."""
+    if len(argv) > 1:
+        if len(argv) == 3 and argv[1] == 'set-season':
+            ow_stats.set_season(int(argv[2]))
+            return True
+
+        if len(argv) > 1 and argv[1] == 'current':
+            ow_stats.current()
+            return True
+
+        if len(argv) == 3 and argv[1] == 'set-next':
+            ow_stats.set_next(argv[2])
+            return True
+
+        if len(argv) in [2, 3] and argv[1] == 'plots':
+            ow_stats.render_plots(int(argv[2]) if len(argv) == 3 else None)
+            return True
+
+        if len(argv) == 3 and argv[1] == 'export':
+            ow_stats.export(argv[2])
+            return True
+
+        if len(argv) == 3 and argv[1] == 'import':
+            ow_stats.import_(argv[2])
+            return True
 
-                if len(sys.argv) > 1 and sys.argv[1] == 'current':
-                    ow_stats.current()
-                    return
+        if len(argv) == 3 and argv[1] == 'add-players':
+            ow_stats.add_players(argv[2])
+            return True
 
-                if len(sys.argv) == 3 and sys.argv[1] == 'set-next':
-                    ow_stats.set_next(sys.argv[2])
-                    return
+        if len(argv) == 2 and argv[1] == 'rollups':
+            ow_stats.rebuild_rollups()
+            return True
 
-                if len(sys.argv) > 1 and sys.argv[1] in ['-h','--help']:
-                    a ="""Usage: OWstats [OPTIONS] COMMAND [ARGS]...
+        if len(argv) == 2 and argv[1] == 'retag-seasons':
+            ow_stats.retag_seasons()
+            return True
+
+        if len(argv) > 1 and argv[1] in ['-h','--help']:
+            a ="""Usage: OWstats [OPTIONS] COMMAND [ARGS]...
 
   Hits the Overwatch API and updates stats for all active players in the database.
 
 Options:
   -h, --help  Show this message and exit.
-  -c          Run continuously in console, don't exit after one run.
+  -c          Run continuously in console, don't exit after one run. Each player is
+              polled more or less often depending on how much they've been playing.
+  -d          Run as a daemon: like -c, but the schedule is shared through the database,
+              so several daemons (on one host or many) can poll the same players without
+              polling anyone twice. SIGTERM stops it after the players in flight.
 
 Commands:
   set-season      Creates a new season entry in seasons table
   current         Display the current season in the database
   set-next        Set the season switch date 
+  add-players     Add all players listed in a CSV or JSON file
+  plots           Render every player's plot for a season
+  rollups         Rebuild the daily, weekly and season rollups
+  retag-seasons   Move stats logged in a season but tagged with an older one
+  export          Export all stats to Parquet files, one per season
+  import          Import stats from Parquet files made by export
                 """
-                    if len(sys.argv) == 3:
-                        if sys.argv[2] == 'set-season':
-                            a = """Usage: OWstats set-season TEXT
+            if len(argv) == 3:
+                if argv[2] == 'set-season':
+                    a = """Usage: OWstats set-season TEXT
 
   Creates a new season entry in seasons table with season=TEXT
                         """
-                        if sys.argv[2] == 'current':
-                            a = """Usage: OWstats current
+                if argv[2] == 'current':
+                    a = """Usage: OWstats current
 
   Prints the current season from the database.
                         """
 
-                        if sys.argv[2] == 'set-next':
-                            a = """Usage: OWstats set-next DATE
+                if argv[2] == 'plots':
+                    a = """Usage: OWstats plots [SEASON]
+
+  Renders the plots of all players with stats in SEASON (the current season by default),
+  using all CPU cores. Plots that are already up to date are skipped.
+                        """
+
+                if argv[2] == 'add-players':
+                    a = """Usage: OWstats add-players FILE
+
+  Adds the players listed in FILE, a CSV file with platform,region,username lines or a
+  .json file with a list of {"platform", "region", "username"} objects. Players already
+  in the database are skipped, the others are looked up in the API and added with their
+  current stats if their profile exists and is public. Prints the result for every line.
+                        """
+
+                if argv[2] == 'rollups':
+                    a = """Usage: OWstats rollups
+
+  Rebuilds the daily_stats, weekly_stats and season_stats tables from all of comp_stats.
+  Only needed once, to backfill the stats logged before the rollup tables existed.
+                        """
+
+                if argv[2] == 'retag-seasons':
+                    a = """Usage: OWstats retag-seasons
+
+  Moves comp_stats rows that were logged after a season's switch date but tagged with
+  an older season into the season they were logged in, and rebuilds the rollups of the
+  players they belong to. Their plots are rendered again when they're next viewed.
+  Seasons start at the previous season's next_switch_date, or when they were added if
+  that wasn't set.
+                        """
+
+                if argv[2] == 'export':
+                    a = """Usage: OWstats export DIR
+
+  Writes comp_stats, with each player's username, platform and region, to
+  DIR/season=N/comp_stats.parquet. Needs pyarrow.
+                        """
+
+                if argv[2] == 'import':
+                    a = """Usage: OWstats import DIR
+
+  Imports all Parquet files under DIR that were written by export. Players that don't
+  exist yet are added, rows that are already in the database are skipped. Needs pyarrow.
+                        """
+
+                if argv[2] == 'set-next':
+                    a = """Usage: OWstats set-next DATE
 
   Updates the current season's next_switch_date to DATE. DATE should be in YYYY/MM/DD format.
                     
                         """
-                    print(a)  
-                    return  
+            print(a)
+            return True
+    return False
+
+
+def run_daemon(ow_stats):
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        logging.info(f'Got signal {signum}, stopping')
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    ow_stats.scheduler = WorkQueue()
+    ow_stats.stopping = stopping
+    logging.info(f'Collector daemon {ow_stats.scheduler.worker} started')
+
+    while not stopping.is_set():
+        try:
+            polled = ow_stats.poll_due_players()
+            ow_stats.reset_sleep_time()
         except Exception:
-            logging.exception("An error was caught")
+            logging.exception("An error in the daemon loop was caught")
+            polled = 0
+            ow_stats.increase_sleep_time()
+        # a full batch means more players are due right now, unless we're backing off from the API
+        if polled < POLL_BATCH or ow_stats.sleep_time_extended:
+            stopping.wait(ow_stats.sleep_time)
+            ow_stats.sleep_time_extended = False
+
+    logging.info('Collector daemon stopped.')
+
+
+# Main loop goes here
+def main():
+    # argv is only looked at once, the loop below runs the mode picked here
+    argv = sys.argv
+    mode = argv[1] if len(argv) > 1 else None
+    ow_stats = OWstats()
+    try:
+        if run_command(ow_stats, argv):
             return
+    except Exception:
+        logging.exception("An error was caught")
+        return
 
+    if mode == '-d':
+        run_daemon(ow_stats)
+        return
 
+    while True:
+        logging.info('Going for another run')
         try:
-            if len(sys.argv) > 1 and sys.argv[1] == '-a':
+            if mode == '-a':
                 ow_stats.log_stats_to_db(all=True)
+            elif mode == '-c':
+                ow_stats.poll_due_players()
             else:
                 ow_stats.log_stats_to_db()
-            if len(sys.argv) > 1 and sys.argv[1] == '-c':
+            if mode == '-c':
                 ow_stats.reset_sleep_time()
             else:
                 logging.info('Run finished, exiting.')
@@ -259,6 +518,7 @@ Commands:
 
         print(f"sleep time: {ow_stats.sleep_time}")
         time.sleep(ow_stats.sleep_time)
+        ow_stats.sleep_time_extended = False
 
 
 try:
@@ -0,0 +1,141 @@
+"""End to end benchmark of the collector against bench/fake_api.py.
+
+    python bench/collector.py --players 2000 --sweeps 3 --latency 0.05
+
+Seeds N synthetic players into a database (a fresh SQLite file by default, or --db, which
+should be a scratch database), then runs full sweeps (OWstats -a) against the fake API and
+reports per sweep: wall time, players per second, new comp_stats rows, DB round trips,
+API responses by status (retries included) and the process's peak memory so far, which
+never goes down (--tracemalloc adds each sweep's own peak). --json saves the numbers, to
+compare runs before and after a change.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fake_api
+
+
+SEED_BATCH = 1000
+
+
+def seed(db, Player, Season, players):
+    """Adds bench0..bench{players-1} (the ones that aren't there yet) and a season."""
+    if Season.query.count() == 0:
+        db.session.add(Season(season=1))
+        db.session.commit()
+    have = {username for username, in db.session.query(Player.username).filter(Player.username.like('bench%'))}
+    rows = [{'username': f'bench{i}', 'platform': 'pc', 'region': 'us', 'games_played': 0}
+            for i in range(players) if f'bench{i}' not in have]
+    with db.engine.begin() as conn:
+        for i in range(0, len(rows), SEED_BATCH):
+            conn.execute(Player.__table__.insert(), rows[i:i + SEED_BATCH])
+    return len(rows)
+
+
+def process_peak_rss_mb():
+    # the peak of the whole process so far, not of a sweep; ru_maxrss is in KB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks collector sweeps against a fake API.')
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--sweeps', type=int, default=3)
+    parser.add_argument('--db', help='database URL, a new SQLite file by default')
+    parser.add_argument('--workers', type=int, help='OWSTATS_WORKERS for the sweeps')
+    parser.add_argument('--api-rate', type=float, default=0, help='OWSTATS_API_RATE, 0 = no client side limit')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='also report the peak of Python allocations per sweep (slows the sweeps down)')
+    parser.add_argument('--json', help='write the results to this file')
+    fake_api.add_arguments(parser)
+    args = parser.parse_args()
+
+    api = fake_api.from_arguments(args).start()
+
+    db_file = None
+    if not args.db:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+        args.db = f'sqlite:///{db_file}'
+    os.environ['OWSTATS_DB'] = args.db
+    os.environ['OWSTATS_API_URL'] = api.url
+    os.environ['OWSTATS_API_RATE'] = str(args.api_rate)
+    if args.workers:
+        os.environ['OWSTATS_WORKERS'] = str(args.workers)
+
+    # before OWstats sets up its log file: log as much as it does, but to nowhere
+    logging.basicConfig(filename=os.devnull, level=logging.INFO)
+    from sqlalchemy import event
+    from owstats import CompStats, Player, Season, db
+    import OWstats
+
+    db.create_all()
+    seeded = seed(db, Player, Season, args.players)
+    print(f'Seeded {seeded} players, fake API at {api.url}')
+
+    queries = [0]
+
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def count_query(*_):
+        queries[0] += 1
+
+    ow_stats = OWstats.OWstats()
+    results = []
+    print(f"{'sweep':>5} {'players':>8} {'seconds':>8} {'players/s':>10} {'new rows':>9} {'queries':>8} "
+          f"{'process peak MB':>15}  responses")
+    try:
+        for sweep in range(1, args.sweeps + 1):
+            if sweep > 1:
+                api.advance()
+            api.reset_counts()
+            db.session.expire_all()
+            players = Player.query.filter(Player.is_due()).count()
+            rows_before = CompStats.query.count()
+            queries[0] = 0
+            if args.tracemalloc:
+                tracemalloc.start()
+
+            start = time.perf_counter()
+            ow_stats.log_stats_to_db(all=True)
+            seconds = time.perf_counter() - start
+
+            db_queries = queries[0]
+            responses = api.reset_counts()
+            result = {
+                'sweep': sweep,
+                'players': players,
+                'seconds': round(seconds, 3),
+                'players_per_second': round(players / seconds, 1) if seconds else None,
+                'new_rows': CompStats.query.count() - rows_before,
+                'queries': db_queries,
+                'responses': {str(status): count for status, count in sorted(responses.items())},
+                'process_peak_rss_mb': process_peak_rss_mb(),
+            }
+            if args.tracemalloc:
+                result['python_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+                tracemalloc.stop()
+            results.append(result)
+            print(f"{sweep:>5} {result['players']:>8} {result['seconds']:>8} {result['players_per_second']:>10} "
+                  f"{result['new_rows']:>9} {result['queries']:>8} {result['process_peak_rss_mb']:>15}  {result['responses']}")
+    finally:
+        api.shutdown()
+        if db_file:
+            os.remove(db_file)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': {k: v for k, v in vars(args).items() if k not in ('db', 'json')},
+                       'sweeps': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""A local stand-in for the ow-api.com profile endpoint, for benchmarks and for trying
+out collector changes without hitting the real API.
+
+    python bench/fake_api.py --port 8080 --latency 0.2 --error-rate 0.05
+
+and point the collector at it with OWSTATS_API_URL=http://127.0.0.1:8080/v1/stats.
+
+Every username gets a stable made-up profile. Which players are private, not found or
+still playing is decided by a hash of the username, so the same players behave the same
+way on every run. The games of the players that are playing go up by one every time
+advance() is called (or every --tick seconds), which is what the collector looks for.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+PROFILE_PATH = re.compile(r'^/v1/stats/(?P<platform>[^/]+)/(?P<region>[^/]+)/(?P<username>[^/]+)/profile$')
+
+
+def _share(username, salt):
+    # a stable number in [0, 1) per username, so the rates pick the same players every run
+    return zlib.crc32(f'{salt}:{username}'.encode()) / 2 ** 32
+
+
+class FakeApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0, error_rate=0.0,
+                 private_rate=0.0, missing_rate=0.0, active_rate=0.5, rate_limit=0, seed=None):
+        super().__init__(address, FakeApiHandler)
+        self.latency = latency              # seconds per response
+        self.jitter = jitter                # +- seconds on top of the latency
+        self.error_rate = error_rate        # share of requests answered with a 500
+        self.private_rate = private_rate    # share of players with a private profile
+        self.missing_rate = missing_rate    # share of players that don't exist
+        self.active_rate = active_rate      # share of players who play between two advance() calls
+        self.rate_limit = rate_limit        # requests per second before answering 429, 0 = no limit
+        self.random = random.Random(seed)
+        self.epoch = 0
+        self.lock = threading.Lock()
+        self.window = (0, 0)                # (second, requests in it) for the rate limit
+        self.counts = {}                    # status code -> responses
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1/stats'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def advance(self, epochs=1):
+        """Lets the active players play another game."""
+        with self.lock:
+            self.epoch += epochs
+
+    def reset_counts(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def _count(self, status):
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+    def _over_rate_limit(self):
+        if not self.rate_limit:
+            return False
+        second = int(time.monotonic())
+        with self.lock:
+            start, count = self.window
+            self.window = (second, count + 1) if start == second else (second, 1)
+            return self.window[1] > self.rate_limit
+
+    def profile(self, username):
+        if _share(username, 'missing') < self.missing_rate:
+            return {'error': 'Player not found'}
+        if _share(username, 'private') < self.private_rate:
+            return {'private': True, 'name': username, 'icon': f'https://example.com/{username}.png'}
+
+        base = int(_share(username, 'games') * 200)
+        played = base + (self.epoch if _share(username, 'active') < self.active_rate else 0)
+        rating = 1500 + int(_share(username, 'rating') * 2500)
+        return {
+            'name': username,
+            'icon': f'https://example.com/{username}.png',
+            'endorsement': 1 + base % 5,
+            'private': False,
+            'rating': rating,
+            'ratings': [
+                {'role': 'tank', 'level': rating - 100 + played % 50},
+                {'role': 'damage', 'level': rating + played % 30},
+                {'role': 'support', 'level': 0 if base % 3 == 0 else rating + 100 - played % 40},
+            ],
+            'competitiveStats': {'games': {'played': played, 'won': played // 2}},
+        }
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, like the real API
+
+    def do_GET(self):
+        api = self.server
+        delay = api.latency + api.jitter * (2 * api.random.random() - 1)
+        if delay > 0:
+            time.sleep(delay)
+
+        match = PROFILE_PATH.match(self.path)
+        if not match:
+            return self._send(404, {'error': 'Not found'})
+        if api._over_rate_limit():
+            return self._send(429, {'error': 'Too many requests'}, {'Retry-After': '1'})
+        if api.error_rate and api.random.random() < api.error_rate:
+            return self._send(500, {'error': 'Internal server error'})
+
+        body = json.dumps(api.profile(match['username'])).encode()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, None, {'ETag': etag})
+        self._send(200, body, {'ETag': etag})
+
+    def _send(self, status, body, headers=None):
+        self.server._count(status)
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        else:
+            self.send_header('Content-Length', '0')
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +- seconds on top of the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failing with a 500')
+    parser.add_argument('--private-rate', type=float, default=0.05, help='share of private profiles')
+    parser.add_argument('--missing-rate', type=float, default=0.02, help='share of players that are not found')
+    parser.add_argument('--active-rate', type=float, default=0.3, help='share of players who play between sweeps')
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests per second before answering 429')
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def from_arguments(args, address=('127.0.0.1', 0)):
+    return FakeApi(address, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                   private_rate=args.private_rate, missing_rate=args.missing_rate, active_rate=args.active_rate,
+                   rate_limit=args.rate_limit, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves fake Overwatch profiles like ow-api.com.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--tick', type=float, default=0, help='seconds between games of the active players, 0 = never')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    api = from_arguments(args, (args.host, args.port))
+    print(f'Serving fake profiles at {api.url}')
+    try:
+        if args.tick:
+            api.start()
+            while True:
+                time.sleep(args.tick)
+                api.advance()
+        else:
+            api.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""How long it takes to start the web app and the collector, measured in fresh processes.
+
+    python bench/import_time.py --runs 10
+
+The "+ plotting stack" rows import matplotlib and pandas on top, which is what every
+start used to pay before they were only imported for rendering plots. The last column
+lists which of the heavy modules each start ended up loading.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HEAVY = ('matplotlib', 'pandas', 'numpy', 'pyarrow')
+
+PLOTTING_STACK = 'import matplotlib.figure, matplotlib.backends.backend_agg, pandas'
+REPORT_HEAVY = f'import sys; print(",".join(m for m in {HEAVY!r} if m in sys.modules))'
+
+CASES = [
+    ('web app (import owstats)', ['-c', f'import owstats; {REPORT_HEAVY}']),
+    ('web app + plotting stack', ['-c', f'import owstats; {PLOTTING_STACK}; {REPORT_HEAVY}']),
+    ('collector (import OWstats)', ['-c', f'import OWstats; {REPORT_HEAVY}']),
+    ('collector + plotting stack', ['-c', f'import OWstats; {PLOTTING_STACK}; {REPORT_HEAVY}']),
+    ('OWstats.py current', [os.path.join(REPO, 'OWstats.py'), 'current']),
+]
+
+
+def run(args, env, cwd):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + args, env=env, cwd=cwd, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError(f'{args} failed:\n{result.stderr}')
+    return seconds, result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the startup time of the web app and the collector.')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, OWSTATS_DB=f"sqlite:///{os.path.join(tmp, 'owstats.db')}",
+                   PYTHONPATH=os.pathsep.join(filter(None, [REPO, os.environ.get('PYTHONPATH')])))
+        # a season for 'current' to print
+        run(['-c', 'from owstats import db, Season; db.create_all(); '
+                   'db.session.add(Season(season=1)); db.session.commit()'], env, tmp)
+
+        print(f"{'':<28} {'median':>8} {'min':>8}  heavy modules loaded")
+        for name, case in CASES:
+            run(case, env, tmp)     # warm up the file cache and .pyc files
+            times = []
+            for _ in range(args.runs):
+                seconds, output = run(case, env, tmp)
+                times.append(seconds)
+            heavy = output if case[0] == '-c' else ''
+            print(f'{name:<28} {statistics.median(times):>7.3f}s {min(times):>7.3f}s  {heavy or "-"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Serves the web app with gunicorn, a pre-forking server:
+
+    gunicorn -c gunicorn.conf.py
+
+The app is imported once in the master and the workers are forked from it. Every
+worker has its own DB connection pool (see owstats/database.py), so the connections
+a worker can use at once, OWSTATS_DB_POOL_SIZE + OWSTATS_DB_MAX_OVERFLOW, should be
+at least its OWSTATS_WEB_THREADS.
+"""
+import multiprocessing
+import os
+import tempfile
+
+# every worker saves its metrics here and /metrics adds them up, set before the app is loaded
+os.environ.setdefault('OWSTATS_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'owstats-metrics'))
+
+
+wsgi_app = 'run:app'
+bind = os.environ.get('OWSTATS_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('OWSTATS_WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('OWSTATS_WEB_THREADS', 4))  # requests per worker at once
+timeout = int(os.environ.get('OWSTATS_WEB_TIMEOUT', 30))  # seconds before a stuck worker is restarted
+preload_app = True
+
+# workers are replaced now and then, so memory from rendering plots doesn't pile up
+max_requests = 2000
+max_requests_jitter = 200
+
+accesslog = '-'
+
+
+def on_starting(server):
+    from owstats.metrics import clear_metrics_dir
+    clear_metrics_dir()
+
+
+def post_fork(server, worker):
+    # connections opened by the master while loading the app would be shared by all
+    # the workers, each worker opens its own
+    from owstats import app, db
+    for bind in [None] + list(app.config['SQLALCHEMY_BINDS'] or ()):
+        db.get_engine(app, bind).dispose()
+
+
+def worker_exit(server, worker):
+    # recycled workers' counts still count
+    from owstats.metrics import archive_metrics
+    archive_metrics()
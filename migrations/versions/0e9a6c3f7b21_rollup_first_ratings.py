@@ -0,0 +1,32 @@
+"""rollup first ratings
+
+Revision ID: 0e9a6c3f7b21
+Revises: f4b8d2e6a913
+Create Date: 2026-10-18 13:48:02.315904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0e9a6c3f7b21'
+down_revision = 'f4b8d2e6a913'
+branch_labels = None
+depends_on = None
+
+TABLES = ['daily_stats', 'weekly_stats', 'season_stats']
+ROLES = ['tank', 'damage', 'support']
+
+
+def upgrade():
+    # existing rollups get these with 'OWstats rollups'
+    for table in TABLES:
+        for role in ROLES:
+            op.add_column(table, sa.Column(f'rating_{role}_first', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        for role in ROLES:
+            op.drop_column(table, f'rating_{role}_first')
@@ -0,0 +1,29 @@
+"""indexes
+
+Revision ID: 8c1f2a9d4b6e
+Revises: e6d44eeda171
+Create Date: 2026-10-18 10:12:41.208377
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8c1f2a9d4b6e'
+down_revision = 'e6d44eeda171'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_players_active_etime', 'players', ['active', 'etime'], unique=False)
+    op.create_index(op.f('ix_players_username'), 'players', ['username'], unique=False)
+    op.create_index('ix_comp_stats_player_id_ctime', 'comp_stats', ['player_id', 'ctime'], unique=False)
+    op.create_index('ix_comp_stats_player_id_season_ctime', 'comp_stats', ['player_id', 'season', 'ctime'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_comp_stats_player_id_season_ctime', table_name='comp_stats')
+    op.drop_index('ix_comp_stats_player_id_ctime', table_name='comp_stats')
+    op.drop_index(op.f('ix_players_username'), table_name='players')
+    op.drop_index('ix_players_active_etime', table_name='players')
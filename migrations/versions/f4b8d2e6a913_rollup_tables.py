@@ -0,0 +1,66 @@
+"""rollup tables
+
+Revision ID: f4b8d2e6a913
+Revises: d2c4a81e6f05
+Create Date: 2026-10-18 13:05:48.771620
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4b8d2e6a913'
+down_revision = 'd2c4a81e6f05'
+branch_labels = None
+depends_on = None
+
+
+def rollup_columns():
+    return [
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('player_id', sa.Integer(), nullable=False),
+        sa.Column('season', sa.Integer(), nullable=False),
+        sa.Column('games_start', sa.Integer(), nullable=True),
+        sa.Column('games_played', sa.Integer(), nullable=True),
+        sa.Column('wins_start', sa.Integer(), nullable=True),
+        sa.Column('games_won', sa.Integer(), nullable=True),
+        sa.Column('rating_avg_last', sa.Integer(), nullable=True),
+        sa.Column('rating_tank_min', sa.Integer(), nullable=True),
+        sa.Column('rating_tank_max', sa.Integer(), nullable=True),
+        sa.Column('rating_tank_last', sa.Integer(), nullable=True),
+        sa.Column('rating_damage_min', sa.Integer(), nullable=True),
+        sa.Column('rating_damage_max', sa.Integer(), nullable=True),
+        sa.Column('rating_damage_last', sa.Integer(), nullable=True),
+        sa.Column('rating_support_min', sa.Integer(), nullable=True),
+        sa.Column('rating_support_max', sa.Integer(), nullable=True),
+        sa.Column('rating_support_last', sa.Integer(), nullable=True),
+        sa.Column('snapshots', sa.Integer(), nullable=False),
+        sa.Column('first_ctime', sa.DateTime(), nullable=False),
+        sa.Column('last_ctime', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['player_id'], ['players.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+    ]
+
+
+def upgrade():
+    op.create_table('daily_stats',
+    *rollup_columns(),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.UniqueConstraint('player_id', 'season', 'day')
+    )
+    op.create_table('weekly_stats',
+    *rollup_columns(),
+    sa.Column('week', sa.Date(), nullable=False),
+    sa.UniqueConstraint('player_id', 'season', 'week')
+    )
+    op.create_table('season_stats',
+    *rollup_columns(),
+    sa.UniqueConstraint('player_id', 'season')
+    )
+
+
+def downgrade():
+    op.drop_table('season_stats')
+    op.drop_table('weekly_stats')
+    op.drop_table('daily_stats')
@@ -1,33 +1,74 @@
 import os
 
-from flask import Flask, flash, redirect, render_template, url_for, request
+from flask import Flask, abort, flash, jsonify, redirect, render_template, url_for, request
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
+from flask_wtf.csrf import validate_csrf
+from werkzeug.http import is_resource_modified
+from wtforms import ValidationError
 
+from owstats.database import (DB_URL, REPLICA_DB_URL, RoutingSQLAlchemy, engine_options, read_only,
+                              stick_to_primary)
 from owstats.forms import AddUserForm
 
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('OWSTATS_DB')
+app.config['SQLALCHEMY_DATABASE_URI'] = DB_URL
+app.config['SQLALCHEMY_BINDS'] = {'replica': REPLICA_DB_URL} if REPLICA_DB_URL else None
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(DB_URL)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 migrate = Migrate(app, db)
 
 
-from owstats.models import CompStats, Player, Season
-from owstats.utils import get_api_response, make_plot, get_player_seasons
+from owstats.models import (CompStats, DailyStats, DataVersion, ImportJob, Player, ProfileHistory, Season,
+                            SeasonStats, WeeklyStats)
+from owstats import jsonapi
+from owstats.importer import MAX_IMPORT_ROWS, get_import_job, parse_players, start_import
+from owstats.ingest import ERROR, NOT_FOUND, PUBLIC, parse_profile
+from owstats.leaderboard import get_leaderboard
+from owstats.metrics import render_metrics, save_metrics
+from owstats.plots import get_plot_image
+from owstats.rollups import stats_row, update_rollups
+from owstats.seasons import roll_over_season
+from owstats.utils import get_api_response, get_current_season, get_player_season_stats, get_player_seasons
+
+
+@app.after_request
+def save_worker_metrics(response):
+    # with several worker processes, /metrics adds up what each of them saved
+    save_metrics()
+    return response
 
 
 @app.route('/')
+@read_only
 def index():
-    users = Player.query.filter_by(active=1).order_by(Player.etime.desc()).all()
-    users = users + Player.query.filter_by(active=2).all()    # inactive
-    users = users + Player.query.filter_by(active=3).all()    # private
+    users = Player.query_by_status(1, 2, 3).all()    # active, inactive, private
 
     return render_template('select_user.html', title='Select user', legend='Select user', users=users)
 
 
+@app.route('/leaderboard')
+@app.route('/leaderboard/<int:season>')
+@read_only
+def leaderboard(season=0):
+    if season == 0:
+        season = get_current_season()
+    days = request.args.get('days', type=int)
+    if days is not None and days < 1:
+        abort(400)
+    sort = request.args.get('sort', 'games')
+    board = get_leaderboard(season, days=days, sort=sort)
+    return render_template('leaderboard.html', title='Leaderboard', legend=f'Season {season}', board=board,
+                           season=season, days=days, sort=sort)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return app.response_class(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/add', methods=['GET', 'POST'])
 def add_user():
     form = AddUserForm()
@@ -48,48 +89,33 @@ def add_user():
             return redirect(url_for('index'))
 
         if response:
-            r_json = response.json()
+            try:
+                profile = parse_profile(response.json())
+            except ValueError:
+                flash('Unexpected answer from the API. Player not added.', 'warning')
+                return redirect(url_for('index'))
 
-            if 'error' in r_json:
-                flash(f"Error returned from API: {r_json['error']}", 'warning')
+            if profile.status in (ERROR, NOT_FOUND):
+                flash(f"Error returned from API: {profile.error}", 'warning')
                 return redirect(url_for('index'))
 
-            if not r_json['private']:
-                player = Player()
-                player.username = form.username.data
-                player.region = form.region.data
-                player.platform = form.platform.data
-                player.games_played = r_json['competitiveStats']['games']['played']
-                player.endorsement = r_json['endorsement']
-                player.icon = r_json['icon']
+            if profile.status == PUBLIC:
+                # not the cached season: right after a rollover that would still be the old one
+                cs = CompStats(**profile.stats(roll_over_season().season))
+                player = Player(username=form.username.data, region=form.region.data, platform=form.platform.data,
+                                stats_hash=cs.content_hash, **profile.player_values())
                 db.session.add(player)
                 db.session.commit()
 
-                current_season = Season.query.order_by(Season.etime.desc()).first()
-
-                cs = CompStats()
-                cs.season = current_season.season
-                cs.games_played = player.games_played
-                cs.games_won = r_json['competitiveStats']['games']['won']
-                cs.rating_avg = r_json['rating']
-                if 'ratings' in r_json and r_json['ratings'] is not None:
-                    for rating in r_json['ratings']:
-                        if rating['role'] == 'tank':
-                            cs.rating_tank = rating['level'] or None
-                        if rating['role'] == 'damage':
-                            cs.rating_damage = rating['level'] or None
-                        if rating['role'] == 'support':
-                            cs.rating_support = rating['level'] or None
-                else: 
-                    cs.rating_tank = None
-                    cs.rating_damage = None
-                    cs.rating_support = None
-
                 cs.player = player
 
                 db.session.add(cs)
+                db.session.add(ProfileHistory(player_id=player.id, icon=player.icon, endorsement=player.endorsement))
+                db.session.flush()
+                update_rollups(db.session.connection(), [stats_row(cs)])
                 db.session.commit()
-                make_plot(player)
+                stick_to_primary()
+                jsonapi.invalidate_players([player.username])
 
                 flash(
                     f'Player {player.username} has been added to the database.', 'success')
@@ -103,16 +129,140 @@ def add_user():
     return render_template('add_user.html', title='Add player', legend='Add player', form=form)
 
 
+@app.route('/import', methods=['POST'])
+def import_players():
+    # a JSON list, CSV as the request body (Content-Type: text/csv) or an uploaded file.
+    # Other sites can't send JSON or text/csv here without a CORS preflight, which fails,
+    # but they can post a form, so uploads need the CSRF token like the add player form.
+    try:
+        if request.is_json:
+            rows = parse_players(request.get_json(), fmt='json')
+        elif request.mimetype == 'text/csv':
+            rows = parse_players(request.get_data(as_text=True))
+        elif 'file' in request.files:
+            validate_csrf(request.form.get('csrf_token'))
+            rows = parse_players(request.files['file'].read().decode('utf-8-sig'))
+        else:
+            return jsonify(error='Send the players as JSON, text/csv or an uploaded file'), 415
+    except ValidationError as e:
+        return jsonify(error=str(e)), 400     # the CSRF check
+    except ValueError as e:
+        return jsonify(error=f'Could not read the player list: {e}'), 400
+    if not rows:
+        return jsonify(error='No players in the list'), 400
+    if len(rows) > MAX_IMPORT_ROWS:
+        return jsonify(error=f'Too many players, at most {MAX_IMPORT_ROWS} per import'), 400
+
+    # the API lookups take a while, so the import runs in the background
+    job = start_import(rows)
+    stick_to_primary()
+    status_url = url_for('import_status', job_id=job.id)
+    return jsonify(job=job.id, total=job.total, status_url=status_url), 202, {'Location': status_url}
+
+
+@app.route('/import/<job_id>')
+def import_status(job_id):
+    job = get_import_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
+def api_response(key, get_version, build, player=None):
+    # the encoded body comes from the cache, this only adds the ETag and the gzip
+    try:
+        entry = jsonapi.cache.get(key, get_version, build, player)
+    except jsonapi.FieldError as e:
+        return jsonify(error=str(e)), 400
+
+    # the gzipped body is a different representation, so it gets its own ETag
+    gzipped = 'gzip' in request.accept_encodings and len(entry.body) >= jsonapi.GZIP_MIN_SIZE
+    etag = f'{entry.etag}-gz' if gzipped else entry.etag
+    if not is_resource_modified(request.environ, etag=etag):
+        response = app.response_class(status=304)
+    elif gzipped:
+        response = app.response_class(entry.gzipped(), mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = app.response_class(entry.body, mimetype='application/json')
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response
+
+
+def api_fields():
+    # ?fields=a,b to get only those, ?format=columns for a list per field instead of a list of objects
+    fields = tuple(field for field in request.args.get('fields', '').split(',') if field)
+    return fields, request.args.get('format') == 'columns'
+
+
+@app.route('/api/players')
+@read_only
+def api_players():
+    fields, columns = api_fields()
+
+    def build():
+        return {'players': jsonapi.select_fields(jsonapi.get_players(), jsonapi.PLAYER_FIELDS, fields, columns)}
+
+    return api_response(('players', fields, columns), jsonapi.players_version, build)
+
+
+@app.route('/api/players/<username>/seasons')
+@read_only
+def api_player_seasons(username):
+    def build():
+        Player.query.filter_by(username=username).first_or_404()
+        return {'player': username, 'seasons': jsonapi.get_player_seasons(username)}
+
+    return api_response(('seasons', username), lambda: jsonapi.player_version(username), build, username)
+
+
+@app.route('/api/players/<username>/<int:season>')
+@read_only
+def api_player_history(username, season):
+    fields, columns = api_fields()
+    period = request.args.get('by')
+    if period not in ['day', 'week']:
+        period = None
+
+    def build():
+        Player.query.filter_by(username=username).first_or_404()
+        rows = jsonapi.get_player_history(username, season, period)
+        return {'player': username, 'season': season, 'by': period,
+                'stats': jsonapi.select_fields(rows, jsonapi.history_fields(period), fields, columns)}
+
+    return api_response(('history', username, season, period, fields, columns),
+                        lambda: jsonapi.player_version(username), build, username)
+
+
+@app.route('/api/players/<username>/<int:season>/series')
+@read_only
+def api_player_series(username, season):
+    def build():
+        Player.query.filter_by(username=username).first_or_404()
+        return jsonapi.get_player_series(username, season)
+
+    return api_response(('series', username, season), lambda: jsonapi.player_version(username), build, username)
+
+
 @app.route('/<username>')
 @app.route('/<username>/<int:season>')
+@read_only
 def stats(username, season=0):
     # show the player profile for that player
     player = Player.query.filter_by(username=username).first()
-    if season == 0:
-        season = Season.query.order_by(Season.etime.desc()).first().season
-    seasons = get_player_seasons(username)
     if player:
-        return render_template('user_stats.html', title=username, user=player, season=season, seasons=seasons)
+        if season == 0:
+            season = get_current_season()
+        seasons = get_player_seasons(player)
+        period = request.args.get('by')
+        if period not in ['day', 'week']:
+            period = None
+        comp_stats = get_player_season_stats(player, season, page=request.args.get('page', 1, type=int), period=period)
+        summary = SeasonStats.query.filter_by(player_id=player.id, season=season).first()
+        return render_template('user_stats.html', title=username, user=player, season=season, seasons=seasons,
+                               comp_stats=comp_stats, period=period, summary=summary)
 
     form = AddUserForm()
     form.username.data = username
@@ -123,12 +273,35 @@ def stats(username, season=0):
 
 @app.route('/chart/<username>')
 @app.route('/chart/<username>/<int:season>')
+@read_only
 def chart(username, season=0):
     # show the player profile for that player
     player = Player.query.filter_by(username=username).first()
-    if season == 0:
-        season = Season.query.order_by(Season.etime.desc()).first().season
-    seasons = get_player_seasons(username)
     if player:
-        plot_fn = f"{player.username}_{player.platform}_{player.region}_{season}.png"
-        return render_template('user_plots.html', title=username, user=player, plot_fn=plot_fn, season=season, seasons=seasons)
+        if season == 0:
+            season = get_current_season()
+        seasons = get_player_seasons(player)
+        return render_template('user_plots.html', title=username, user=player, season=season, seasons=seasons)
+
+
+@app.route('/chart/<username>/<int:season>.png')
+@read_only
+def chart_image(username, season):
+    player = Player.query.filter_by(username=username).first_or_404()
+    last_modified = db.session.query(db.func.max(CompStats.ctime)) \
+        .filter_by(player_id=player.id, season=season).scalar()
+    if last_modified is None:
+        abort(404)
+
+    # the chart only changes when a new row is logged, so the newest row is all browsers
+    # and proxies need to revalidate the image, without us rendering or sending it again
+    etag = f'{player.id}-{season}-{last_modified:%Y%m%d%H%M%S%f}'
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = app.response_class(get_plot_image(player, season), mimetype='image/png')
+    else:
+        response = app.response_class(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,59 @@
+import functools
+import os
+import time
+
+from flask import g, has_request_context, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+
+
+DB_URL = os.environ.get('OWSTATS_DB')
+REPLICA_DB_URL = os.environ.get('OWSTATS_DB_REPLICA')  # read-only pages are served from here if set
+DB_POOL_SIZE = int(os.environ.get('OWSTATS_DB_POOL_SIZE', 5))  # connections kept open per process
+DB_MAX_OVERFLOW = int(os.environ.get('OWSTATS_DB_MAX_OVERFLOW', 10))  # extra connections under load
+DB_POOL_RECYCLE = int(os.environ.get('OWSTATS_DB_POOL_RECYCLE', 1800))  # seconds, below the server's idle timeout
+DB_POOL_TIMEOUT = int(os.environ.get('OWSTATS_DB_POOL_TIMEOUT', 10))  # seconds to wait for a free connection
+REPLICA_STICKY = int(os.environ.get('OWSTATS_REPLICA_STICKY', 10))  # seconds a client reads from the primary after a write
+
+
+def engine_options(url=DB_URL):
+    """Pool settings for the engines. Connections are checked before use (pre-ping) and
+    replaced after DB_POOL_RECYCLE seconds, so a restarted or failed over DB server or a
+    firewall dropping idle connections doesn't fail requests."""
+    options = {'pool_pre_ping': True, 'pool_recycle': DB_POOL_RECYCLE}
+    # SQLite doesn't use a connection pool that can be sized
+    if url and not url.startswith('sqlite'):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    return options
+
+
+class RoutingSession(SignallingSession):
+    """Runs the queries of read_only views on the replica, if there is one. Everything
+    else, the collector and the views that write included, uses the primary."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if REPLICA_DB_URL and not self._flushing and has_request_context() and g.get('read_only'):
+            return get_state(self.app).db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def read_only(view):
+    """Marks a view that only reads, so it can be served from the replica. Clients that
+    just wrote something keep reading from the primary for REPLICA_STICKY seconds, so
+    they see their change before it has reached the replica."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = time.time() >= session.get('primary_until', 0)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def stick_to_primary():
+    """Call after a write in a view."""
+    if REPLICA_DB_URL:
+        session['primary_until'] = time.time() + REPLICA_STICKY
@@ -0,0 +1,124 @@
+import glob
+import logging
+import os
+from collections import defaultdict
+
+from owstats import CompStats, Player, db
+from owstats.ingest import snapshot_hash
+
+
+EXPORT_CHUNK = 50000    # rows read from the DB / a parquet file at a time
+
+# comp_stats columns in the export, plus who the player is, so files can be imported into another DB
+STATS_COLUMNS = ['id', 'player_id', 'season', 'games_played', 'games_won', 'rating_avg',
+                 'rating_tank', 'rating_damage', 'rating_support', 'ctime']
+PLAYER_COLUMNS = ['username', 'region', 'platform']
+
+
+def _schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('id', pa.int64()),
+        ('player_id', pa.int64()),
+        ('season', pa.int32()),
+        ('games_played', pa.int32()),
+        ('games_won', pa.int32()),
+        ('rating_avg', pa.int32()),
+        ('rating_tank', pa.int32()),
+        ('rating_damage', pa.int32()),
+        ('rating_support', pa.int32()),
+        ('ctime', pa.timestamp('us')),
+        ('username', pa.string()),
+        ('region', pa.string()),
+        ('platform', pa.string()),
+    ])
+
+
+def export_comp_stats(out_dir):
+    """Writes comp_stats joined with players to out_dir/season=N/comp_stats.parquet, one
+    file per season. Rows are read EXPORT_CHUNK at a time, by id, and every chunk becomes
+    a row group, so memory use doesn't depend on how much history there is.
+    Returns the number of rows exported."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _schema()
+    stats = CompStats.__table__
+    players = Player.__table__
+    query = db.select([stats.c[name] for name in STATS_COLUMNS] + [players.c[name] for name in PLAYER_COLUMNS]) \
+        .select_from(stats.join(players))
+
+    writers = {}    # season -> ParquetWriter
+    count = 0
+    last_id = 0
+    try:
+        while True:
+            with db.engine.connect() as conn:
+                rows = conn.execute(query.where(stats.c.id > last_id).order_by(stats.c.id).limit(EXPORT_CHUNK)).fetchall()
+            if not rows:
+                break
+
+            by_season = defaultdict(lambda: defaultdict(list))
+            for row in rows:
+                columns = by_season[row.season]
+                for name in schema.names:
+                    columns[name].append(row[name])
+
+            for season, columns in by_season.items():
+                if season not in writers:
+                    season_dir = os.path.join(out_dir, f'season={season}')
+                    os.makedirs(season_dir, exist_ok=True)
+                    writers[season] = pq.ParquetWriter(os.path.join(season_dir, 'comp_stats.parquet'), schema)
+                writers[season].write_table(pa.Table.from_pydict(columns, schema=schema))
+
+            last_id = rows[-1].id
+            count += len(rows)
+            logging.info(f'Exported {count} rows')
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return count
+
+
+def import_comp_stats(in_dir):
+    """Loads parquet files written by export_comp_stats back in, EXPORT_CHUNK rows at a time.
+    Players are matched by username/platform/region and created if they don't exist.
+    Rows that are already in the DB (same player and ctime) are skipped, so an import can
+    be re-run. Returns the number of rows imported.
+
+    The rollups aren't touched, run rebuild_rollups() afterwards."""
+    import pyarrow.parquet as pq
+
+    player_ids = {(p.username, p.platform, p.region): p.id
+                  for p in db.session.query(Player.id, Player.username, Player.platform, Player.region)}
+    stats = CompStats.__table__
+    count = 0
+
+    for path in sorted(glob.glob(os.path.join(in_dir, '**', '*.parquet'), recursive=True)):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=EXPORT_CHUNK):
+            columns = batch.to_pydict()
+            rows = [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+            with db.engine.begin() as conn:
+                for row in rows:
+                    key = (row['username'], row['platform'], row['region'])
+                    if key not in player_ids:
+                        player = {'username': row['username'], 'platform': row['platform'], 'region': row['region']}
+                        player_ids[key] = conn.execute(Player.__table__.insert(), player).inserted_primary_key[0]
+                    row['player_id'] = player_ids[key]
+
+                # skip what's already there, one query per batch
+                ids = {row['player_id'] for row in rows}
+                ctimes = [row['ctime'] for row in rows]
+                existing = {tuple(row) for row in conn.execute(
+                    db.select([stats.c.player_id, stats.c.ctime])
+                    .where(stats.c.player_id.in_(ids), stats.c.ctime.between(min(ctimes), max(ctimes))))}
+                new_rows = [dict({name: row[name] for name in STATS_COLUMNS if name != 'id'},
+                                 content_hash=snapshot_hash(row))
+                            for row in rows if (row['player_id'], row['ctime']) not in existing]
+                if new_rows:
+                    conn.execute(stats.insert(), new_rows)
+
+            count += len(new_rows)
+            logging.info(f'Imported {count} rows from {path}')
+    return count
@@ -0,0 +1,293 @@
+import csv
+import io
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from owstats import CompStats, ImportJob, Player, ProfileHistory, db
+from owstats.forms import AddUserForm
+from owstats.ingest import ERROR, NOT_FOUND, PRIVATE, PUBLIC, parse_profiles
+from owstats.jsonapi import invalidate_players
+from owstats.rollups import update_rollups
+from owstats.seasons import roll_over_season
+from owstats.utils import get_api_response
+from owstats.writer import BATCH_SIZE
+
+
+IMPORT_WORKERS = int(os.environ.get('OWSTATS_IMPORT_WORKERS', 8))  # concurrent API checks per import
+MAX_IMPORT_ROWS = int(os.environ.get('OWSTATS_MAX_IMPORT_ROWS', 1000))  # players per import
+MAX_IMPORT_JOBS = 100   # finished jobs kept around for their results
+IMPORT_LEASE = 60       # seconds an import's worker may go without saving progress before another resumes it
+PROGRESS_INTERVAL = 5   # seconds between saves of an import's results
+LOOKUP_CHUNK = 500      # usernames per duplicate check query
+
+PLATFORMS = [value for value, _ in AddUserForm.platform.kwargs['choices']]
+REGIONS = [value for value, _ in AddUserForm.region.kwargs['choices']]
+FIELDS = ('platform', 'region', 'username')
+
+
+def parse_players(data, fmt='csv'):
+    """Turns an uploaded player list into rows of platform, region and username.
+    `data` is CSV (with or without a platform,region,username header) or JSON, a list of
+    objects with those keys or of [platform, region, username] lists."""
+    if fmt == 'json':
+        items = json.loads(data) if isinstance(data, (str, bytes)) else data
+        if not isinstance(items, list):
+            raise ValueError('Expected a list of players')
+    else:
+        items = [line for line in csv.reader(io.StringIO(data)) if any(field.strip() for field in line)]
+        if items and [field.strip().lower() for field in items[0]] == list(FIELDS):
+            items = items[1:]
+
+    rows = []
+    for item in items:
+        if isinstance(item, dict):
+            item = [item.get(field) for field in FIELDS]
+        if not isinstance(item, (list, tuple)):
+            item = []
+        rows.append({field: str(value).strip() if value is not None else '' for field, value in zip(FIELDS, item)})
+    return rows
+
+
+def _check_row(row):
+    if not all(row.get(field) for field in FIELDS):
+        return 'Needs platform, region and username'
+    if row['platform'] not in PLATFORMS:
+        return f"Unknown platform {row['platform']}"
+    if row['region'] not in REGIONS:
+        return f"Unknown region {row['region']}"
+    if len(row['username']) > Player.username.type.length:
+        return 'Username too long'
+
+
+def _existing_usernames(usernames):
+    players = Player.__table__
+    usernames = list(usernames)
+    existing = set()
+    with db.engine.connect() as conn:
+        for i in range(0, len(usernames), LOOKUP_CHUNK):
+            query = db.select([players.c.username]).where(players.c.username.in_(usernames[i:i + LOOKUP_CHUNK]))
+            existing.update(username for username, in conn.execute(query))
+    return existing
+
+
+def _fetch(result):
+    """The player's profile payload from the API, None (and the result's status set)
+    if the request failed."""
+    try:
+        response = get_api_response(result['platform'], result['region'], result['username'])
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        result.update(status='error', message=f'API request failed: {e}')
+
+
+def _insert_batch(batch):
+    """Inserts the players, their first CompStats rows and ProfileHistory rows in one transaction.
+    Returns the new player ids, in batch order."""
+    players = Player.__table__
+    with db.engine.begin() as conn:
+        conn.execute(players.insert(), [player for _, player, _ in batch])
+
+        # executemany doesn't hand back the new ids, read them back in one query instead
+        keys = {(p['username'], p['platform'], p['region']) for _, p, _ in batch}
+        ids = {}
+        for player_id, username, platform, region in conn.execute(
+                db.select([players.c.id, players.c.username, players.c.platform, players.c.region])
+                .where(players.c.username.in_({key[0] for key in keys})).order_by(players.c.id)):
+            ids[(username, platform, region)] = player_id
+
+        player_ids = [ids[(p['username'], p['platform'], p['region'])] for _, p, _ in batch]
+        stats = [dict(row, player_id=player_id) for (_, _, row), player_id in zip(batch, player_ids)]
+        conn.execute(CompStats.__table__.insert(), stats)
+        update_rollups(conn, stats)
+        conn.execute(ProfileHistory.__table__.insert(),
+                     [{'player_id': player_id, 'icon': player['icon'], 'endorsement': player['endorsement'],
+                       'valid_from': row['ctime']} for (_, player, row), player_id in zip(batch, player_ids)])
+    return player_ids
+
+
+def import_players(rows, on_result=None, done=()):
+    """Adds a list of players (dicts with platform, region and username) the way the add
+    player form does, but many at once.
+
+    Rows are checked for duplicates against the DB in one query per LOOKUP_CHUNK names,
+    the rest are looked up in the API IMPORT_WORKERS at a time, and the players that
+    exist and are public are inserted with their first stats, BATCH_SIZE players per
+    transaction. Returns a result per row, in input order, with its status: added,
+    exists, duplicate, invalid, not_found, private or error.
+
+    `on_result(result)` is called as each row is decided, for progress reporting. Rows
+    whose numbers are in `done`, already imported by a run that was cut short, are left out."""
+    def decide(result, status, message):
+        result.update(status=status, message=message)
+        if on_result:
+            on_result(result)
+
+    results = []
+    for index, row in enumerate(rows):
+        if index + 1 in done:
+            continue
+        result = dict({field: row.get(field, '') for field in FIELDS}, row=index + 1, status=None, message=None)
+        results.append(result)
+        message = _check_row(row)
+        if message:
+            decide(result, 'invalid', message)
+
+    # one query for the duplicates against the DB, usernames are what the pages look players up by
+    seen = set()
+    pending = [result for result in results if not result['status']]
+    existing = _existing_usernames({result['username'] for result in pending})
+    to_check = []
+    for result in pending:
+        if result['username'] in existing:
+            decide(result, 'exists', 'Player already in the database')
+        elif result['username'] in seen:
+            decide(result, 'duplicate', 'Player listed more than once')
+        else:
+            seen.add(result['username'])
+            to_check.append(result)
+
+    season = roll_over_season().season     # uncached, the rows are tagged with it
+
+    def insert(fetched):
+        batch = []
+        for (result, _), profile in zip(fetched, parse_profiles(r_json for _, r_json in fetched)):
+            if profile.status == PUBLIC:
+                stats = dict(profile.stats(season), ctime=datetime.utcnow())
+                player = dict(profile.player_values(), username=result['username'], region=result['region'],
+                              platform=result['platform'], stats_hash=stats['content_hash'])
+                batch.append((result, player, stats))
+            elif profile.status == PRIVATE:
+                decide(result, 'private', 'Profile is private')
+            elif profile.status == NOT_FOUND:
+                decide(result, 'not_found', profile.error)
+            elif profile.status == ERROR:
+                decide(result, 'error', f'Error returned from API: {profile.error}')
+            else:
+                decide(result, 'error', f'Unexpected profile from the API: {profile.error}')
+        if not batch:
+            return
+
+        try:
+            _insert_batch(batch)
+        except Exception as e:
+            logging.exception(f'Could not insert a batch of {len(batch)} players')
+            for result, _, _ in batch:
+                decide(result, 'error', f'Could not save player: {e}')
+            return
+        invalidate_players([player['username'] for _, player, _ in batch])
+        for result, _, _ in batch:
+            decide(result, 'added', 'Player added')
+
+    # the API lookups are rate limited per host in get_api_response, the profiles are
+    # parsed and inserted on this thread, a batch at a time, as the lookups finish
+    fetched = []
+    with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+        for result, r_json in zip(to_check, executor.map(_fetch, to_check)):
+            if r_json is None:
+                decide(result, result['status'], result['message'])
+                continue
+            fetched.append((result, r_json))
+            if len(fetched) >= BATCH_SIZE:
+                insert(fetched)
+                fetched = []
+    if fetched:
+        insert(fetched)
+
+    logging.info(f'Imported {sum(result["status"] == "added" for result in results)} of {len(results)} players')
+    return results
+
+
+class JobLost(Exception):
+    """Another worker took the import over, after this one didn't save progress in time."""
+
+
+def _claim(job_id, token):
+    """Claims a queued import, or one whose worker stopped saving progress. Returns False
+    if another worker holds it or it's over."""
+    now = datetime.utcnow()
+    jobs = ImportJob.__table__
+    with db.engine.begin() as conn:
+        return conn.execute(jobs.update()
+                            .where(jobs.c.id == job_id, jobs.c.status.in_(['queued', 'running']),
+                                   db.or_(jobs.c.claimed_until.is_(None), jobs.c.claimed_until < now))
+                            .values(status='running', claimed_by=token,
+                                    claimed_until=now + timedelta(seconds=IMPORT_LEASE))).rowcount == 1
+
+
+def _save(job_id, token, results, **values):
+    jobs = ImportJob.__table__
+    with db.engine.begin() as conn:
+        saved = conn.execute(jobs.update()
+                             .where(jobs.c.id == job_id, jobs.c.claimed_by == token)
+                             .values(results=json.dumps(results), **values)).rowcount
+    if not saved:
+        raise JobLost(job_id)
+
+
+def _run_job(job_id):
+    token = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+    try:
+        if not _claim(job_id, token):
+            return
+        job = db.session.get(ImportJob, job_id)
+        rows = json.loads(job.rows)
+        results = json.loads(job.results)
+        last_save = [time.monotonic()]
+
+        def on_result(result):
+            results.append(result)
+            if time.monotonic() - last_save[0] >= PROGRESS_INTERVAL:
+                _save(job_id, token, results,
+                      claimed_until=datetime.utcnow() + timedelta(seconds=IMPORT_LEASE))
+                last_save[0] = time.monotonic()
+
+        try:
+            import_players(rows, on_result=on_result, done={result['row'] for result in results})
+            status = 'finished'
+        except JobLost:
+            raise
+        except Exception:
+            logging.exception(f'Import {job_id} failed')
+            status = 'failed'
+        _save(job_id, token, results, status=status, etime=datetime.utcnow(), claimed_by=None, claimed_until=None)
+    except JobLost:
+        logging.warning(f'Import {job_id} was taken over by another worker')
+    finally:
+        db.session.remove()     # the session of this worker thread
+
+
+# one import at a time per process, they share the API rate limit with each other and the collector anyway
+_import_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def start_import(rows):
+    """Saves an import and starts it in the background, returns its job to poll with get_import_job()."""
+    job = ImportJob(id=uuid.uuid4().hex, total=len(rows), rows=json.dumps(rows), results='[]')
+    db.session.add(job)
+    db.session.commit()
+
+    # drop the results of old imports, the newest MAX_IMPORT_JOBS are kept
+    old = db.session.query(ImportJob.id).filter(ImportJob.status.in_(['finished', 'failed'])) \
+        .order_by(ImportJob.ctime.desc()).offset(MAX_IMPORT_JOBS)
+    ImportJob.query.filter(ImportJob.id.in_(old.scalar_subquery())).delete(synchronize_session=False)
+    db.session.commit()
+
+    _import_executor.submit(_run_job, job.id)
+    return job
+
+
+def get_import_job(job_id):
+    """The import, resumed in this process if the worker that ran it is gone (e.g.
+    recycled by gunicorn) or never got to it."""
+    job = db.session.get(ImportJob, job_id)
+    if job is not None and job.status in ('queued', 'running') \
+            and (job.claimed_until or job.ctime + timedelta(seconds=IMPORT_LEASE)) < datetime.utcnow():
+        _import_executor.submit(_run_job, job.id)
+    return job
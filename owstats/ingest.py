@@ -0,0 +1,120 @@
+import hashlib
+
+
+ROLES = ('tank', 'damage', 'support')
+ROLE_SLOTS = {role: f'rating_{role}' for role in ROLES}
+
+PUBLIC = 'public'
+PRIVATE = 'private'
+NOT_FOUND = 'not_found'
+ERROR = 'error'       # the API answered with an error
+INVALID = 'invalid'   # the payload doesn't look like a profile, only from parse_profiles()
+
+# what a snapshot is made of, a new one is logged when any of them changes
+SNAPSHOT_FIELDS = ('games_played', 'games_won', 'rating_avg', 'rating_tank', 'rating_damage', 'rating_support')
+
+
+class ProfileError(ValueError):
+    """The API's JSON doesn't have the shape we expect, e.g. after a change to the API."""
+
+
+class Profile:
+    """What we keep from one API profile payload. Only public profiles have stats."""
+
+    __slots__ = ('status', 'error', 'games_played', 'games_won', 'rating_avg',
+                 'rating_tank', 'rating_damage', 'rating_support', 'endorsement', 'icon')
+
+    def __init__(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.games_played = self.games_won = self.rating_avg = None
+        self.rating_tank = self.rating_damage = self.rating_support = None
+        self.endorsement = self.icon = None
+
+    def __repr__(self):
+        if self.error:
+            return f'<Profile {self.status}: {self.error}>'
+        if self.status != PUBLIC:
+            return f'<Profile {self.status}>'
+        return f'<Profile games:{self.games_played} rating:{self.rating_avg}>'
+
+    def stats(self, season):
+        """Column values of the profile's CompStats row."""
+        stats = {
+            'season': season,
+            'games_played': self.games_played,
+            'games_won': self.games_won,
+            'rating_avg': self.rating_avg,
+            'rating_tank': self.rating_tank,
+            'rating_damage': self.rating_damage,
+            'rating_support': self.rating_support,
+        }
+        stats['content_hash'] = snapshot_hash(stats)
+        return stats
+
+    def player_values(self):
+        """Player columns that come from the profile."""
+        return {'games_played': self.games_played, 'endorsement': self.endorsement, 'icon': self.icon}
+
+
+def snapshot_hash(stats):
+    """Hash of the SNAPSHOT_FIELDS of a CompStats row (or a dict like Profile.stats()).
+    The season isn't part of it: stats that didn't change over a rollover aren't new."""
+    content = '|'.join('' if stats[field] is None else str(stats[field]) for field in SNAPSHOT_FIELDS)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def _int(value, name):
+    # bool is an int too, but never a valid count or rating
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ProfileError(f'{name} should be a number, got {value!r}')
+    return value
+
+
+def parse_profile(r_json):
+    """Parses a profile payload from the API into a Profile.
+    Raises ProfileError if it's not a payload we understand."""
+    if not isinstance(r_json, dict):
+        raise ProfileError(f'Expected an object, got {type(r_json).__name__}')
+
+    if 'error' in r_json:
+        error = r_json['error']
+        return Profile(NOT_FOUND if error == "Player not found" else ERROR, error)
+    if 'private' not in r_json:
+        raise ProfileError('No private flag')
+    if r_json['private']:
+        return Profile(PRIVATE)
+
+    profile = Profile(PUBLIC)
+    try:
+        games = r_json['competitiveStats']['games']
+        profile.games_played = _int(games['played'], 'games played')
+        profile.games_won = _int(games['won'], 'games won')
+    except (KeyError, TypeError):
+        raise ProfileError('No competitive games')
+    profile.rating_avg = _int(r_json.get('rating'), 'rating')
+    profile.endorsement = r_json.get('endorsement')
+    profile.icon = r_json.get('icon')
+
+    ratings = r_json.get('ratings') or ()
+    if not isinstance(ratings, list):
+        raise ProfileError(f'ratings should be a list, got {ratings!r}')
+    for rating in ratings:
+        # roles we don't know about are skipped, 0 or no level means no rating in that role
+        slot = ROLE_SLOTS.get(rating.get('role')) if isinstance(rating, dict) else None
+        if slot and rating.get('level') is not None:
+            setattr(profile, slot, _int(rating['level'], f"{rating['role']} rating") or None)
+    return profile
+
+
+def parse_profiles(payloads):
+    """parse_profile() for many payloads at once. Payloads that can't be parsed come
+    back as INVALID profiles with the reason in `error`, so one bad payload doesn't
+    cost the rest of the batch."""
+    profiles = []
+    for r_json in payloads:
+        try:
+            profiles.append(parse_profile(r_json))
+        except ProfileError as e:
+            profiles.append(Profile(INVALID, str(e)))
+    return profiles
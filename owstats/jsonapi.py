@@ -0,0 +1,206 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+from owstats import CompStats, Player, db
+from owstats.rollups import get_rollup_model, get_season_series
+from owstats.utils import RANKS
+
+
+API_CACHE_TTL = int(os.environ.get('OWSTATS_API_CACHE_TTL', 60))  # seconds before a response is checked again
+API_CACHE_SIZE = int(os.environ.get('OWSTATS_API_CACHE_SIZE', 2000))  # responses kept
+GZIP_MIN_SIZE = 1024    # smaller bodies aren't worth compressing
+
+PLAYER_FIELDS = ['username', 'platform', 'region', 'active', 'icon', 'endorsement', 'games_played', 'etime']
+
+
+class FieldError(ValueError):
+    pass
+
+
+class CachedResponse:
+    __slots__ = ('body', 'etag', 'version', 'player', 'expires', '_gzipped')
+
+    def __init__(self, body, version, player):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.version = version
+        self.player = player    # username the response is about, None for the player list
+        self.expires = time.monotonic() + API_CACHE_TTL
+        self._gzipped = None
+
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=6)
+        return self._gzipped
+
+
+class ResponseCache:
+    """Encoded JSON responses, least recently used ones dropped first.
+
+    Within API_CACHE_TTL a response is served as is, without touching the DB. After
+    that its version (a cheap query, e.g. the player's newest comp_stats id) is checked
+    and the response is only rebuilt if the version changed. Writers in this process
+    also drop a player's responses right away with invalidate_players().
+    """
+
+    def __init__(self, size=API_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, get_version, build, player=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                if time.monotonic() < entry.expires:
+                    return entry
+
+        version = get_version()
+        if entry is not None and entry.version == version:
+            entry.expires = time.monotonic() + API_CACHE_TTL
+            return entry
+
+        entry = CachedResponse(_encode(build()), version, player)
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, usernames):
+        # the player list shows games played, so it goes too
+        with self.lock:
+            for key in [key for key, entry in self.entries.items()
+                        if entry.player is None or entry.player in usernames]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+cache = ResponseCache()
+
+
+def invalidate_players(usernames):
+    """Call after writing new stats for these players."""
+    if usernames:
+        cache.invalidate(set(usernames))
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _encode(data):
+    return json.dumps(data, separators=(',', ':'), default=_default).encode()
+
+
+def select_fields(rows, available, fields=None, columns=False):
+    """Keeps only `fields` (all of `available` if None) of the rows, as a list of objects
+    or, with `columns`, as one list per field, which is much smaller for long histories."""
+    fields = fields or available
+    unknown = [field for field in fields if field not in available]
+    if unknown:
+        raise FieldError(f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(available)}")
+    if columns:
+        return {field: [row[field] for row in rows] for field in fields}
+    return [{field: row[field] for field in fields} for row in rows]
+
+
+def players_version():
+    return db.session.query(db.func.count(Player.id), db.func.max(Player.etime)).one()
+
+
+def get_players():
+    players = Player.__table__
+    query = db.select([players.c[field] for field in PLAYER_FIELDS]).order_by(players.c.username)
+    return [dict(row) for row in db.session.execute(query).mappings()]
+
+
+def player_version(username):
+    # the rollups are built from comp_stats, so its rows cover both: a new row changes the
+    # newest id, a row moved to a later season by retag-seasons changes the sum of seasons
+    return db.session.query(db.func.max(CompStats.id), db.func.sum(CompStats.season)) \
+        .join(Player, Player.id == CompStats.player_id).filter(Player.username == username).one()
+
+
+def get_player_seasons(username):
+    seasons = db.session.query(CompStats.season).join(Player, Player.id == CompStats.player_id) \
+        .filter(Player.username == username).distinct().order_by(CompStats.season.desc())
+    return [season for season, in seasons]
+
+
+def history_fields(period=None):
+    table = (get_rollup_model(period) if period else CompStats).__table__
+    return [column.name for column in table.columns if column.name not in ('id', 'player_id', 'content_hash')]
+
+
+def get_player_history(username, season, period=None):
+    """The player's comp_stats rows of the season, oldest first, or the day/week rollups."""
+    table = (get_rollup_model(period) if period else CompStats).__table__
+    order = table.c.first_ctime if period else table.c.ctime
+    player_id = db.session.query(Player.id).filter_by(username=username).scalar()
+    query = db.select([table.c[field] for field in history_fields(period)]) \
+        .where(table.c.player_id == player_id, table.c.season == season).order_by(order)
+    return [dict(row) for row in db.session.execute(query).mappings()]
+
+
+def delta_encode(values):
+    """The first value, then each value minus the one before it. Missing values (no
+    rating in that role yet) stay null and are skipped over by the next difference."""
+    encoded = []
+    last = None
+    for value in values:
+        if value is None:
+            encoded.append(None)
+        else:
+            encoded.append(value if last is None else value - last)
+            last = value
+    return encoded
+
+
+def rank_bands(levels):
+    """The ranks the levels fall in, and the rank lines worth drawing: the ones within
+    50 SR of the range, the same ones make_plot() draws."""
+    levels = [level for level in levels if level is not None]
+    if not levels:
+        return [], []
+    low, high = min(levels), max(levels)
+    lines = [sr for sr, _ in RANKS if sr and sr + 50 > low and sr - 50 < high]
+    bands = []
+    for i, (start, name) in enumerate(RANKS):
+        end = RANKS[i + 1][0] if i + 1 < len(RANKS) else None
+        if start <= high and (end is None or end > low):
+            bands.append({'rank': name, 'from': start, 'to': end})
+    return lines, bands
+
+
+def get_player_series(username, season):
+    """The season's chart data: games played and the SR per role, delta encoded, from
+    the same (downsampled) points the PNG chart uses, with the rank lines and bands."""
+    player = Player.query.filter_by(username=username).first()
+    points = get_season_series(player, season) or []
+    games, tank, damage, support = (list(values) for values in zip(*points)) if points else ([], [], [], [])
+    lines, bands = rank_bands(tank + damage + support)
+    return {
+        'player': username,
+        'season': season,
+        'encoding': 'delta',
+        'points': len(points),
+        'games_played': delta_encode(games),
+        'tank': delta_encode(tank),
+        'damage': delta_encode(damage),
+        'support': delta_encode(support),
+        'rank_lines': lines,
+        'rank_bands': bands,
+    }
@@ -0,0 +1,101 @@
+import threading
+from datetime import datetime, timedelta
+
+from owstats import CompStats, DailyStats, Player, SeasonStats, db
+from owstats.rollups import ROLES, get_stats_version
+
+
+MAX_DAYS = 366     # longer windows are clamped to this, no season is that long
+SORT_KEYS = ['games', 'win_rate'] + [f'{role}_current' for role in ROLES] + [f'{role}_delta' for role in ROLES]
+
+_cache = {}     # (season, days, sort) -> leaderboard, all for the same data version
+_cache_version = None
+_cache_lock = threading.Lock()
+
+
+def get_data_version():
+    # the collector only adds rows, which changes the newest id; retag-seasons and rollup
+    # rebuilds change rows that are already there, and bump the stats version for that
+    return db.session.query(db.func.max(CompStats.id)).scalar(), get_stats_version()
+
+
+def compute_leaderboard(season, days=None):
+    """Every player's summary for the season, or for its last `days` days, as a DataFrame
+    indexed by player id: games and wins in the window, win rate, and the first, peak and
+    current SR and SR delta per role.
+
+    One query fetches the players' rollup rows (season_stats for the whole season,
+    daily_stats for a window), everything else is done by pandas on the whole table."""
+    import pandas as pd     # only loaded when a leaderboard is computed, it's slow to import
+
+    model = DailyStats if days else SeasonStats
+    columns = [model.player_id, Player.username, Player.platform, Player.region, model.first_ctime,
+               model.games_start, model.games_played, model.wins_start, model.games_won]
+    for role in ROLES:
+        columns += [getattr(model, f'rating_{role}_{stat}') for stat in ('first', 'max', 'last')]
+    query = db.session.query(*columns).join(Player, Player.id == model.player_id).filter(model.season == season)
+    if days:
+        query = query.filter(DailyStats.day >= datetime.utcnow().date() - timedelta(days=days - 1))
+
+    df = pd.DataFrame.from_records(query.all(), columns=[c['name'] for c in query.column_descriptions])
+    if df.empty:
+        return df
+
+    aggregations = {
+        'username': ('username', 'first'),
+        'platform': ('platform', 'first'),
+        'region': ('region', 'first'),
+        'games_start': ('games_start', 'min'),
+        'games_played': ('games_played', 'max'),
+        'wins_start': ('wins_start', 'min'),
+        'games_won': ('games_won', 'max'),
+    }
+    for role in ROLES:
+        aggregations[f'{role}_first'] = (f'rating_{role}_first', 'first')
+        aggregations[f'{role}_peak'] = (f'rating_{role}_max', 'max')
+        aggregations[f'{role}_current'] = (f'rating_{role}_last', 'last')
+    board = df.sort_values('first_ctime').groupby('player_id').agg(**aggregations)
+
+    if days:
+        board['games'] = board['games_played'] - board['games_start']
+        board['wins'] = board['games_won'] - board['wins_start']
+    else:
+        # the API's counts start from zero every season
+        board['games'] = board['games_played']
+        board['wins'] = board['games_won']
+    board['win_rate'] = (100 * board['wins'] / board['games'].where(board['games'] > 0)).round(2)
+    for role in ROLES:
+        board[f'{role}_delta'] = board[f'{role}_current'] - board[f'{role}_first']
+    counts = ['games', 'wins'] + [f'{role}_{stat}' for role in ROLES for stat in ('first', 'peak', 'current', 'delta')]
+    board[counts] = board[counts].astype('Int64')  # stay integers even with missing values
+    return board.drop(columns=['games_start', 'games_played', 'wins_start', 'games_won'])
+
+
+def get_leaderboard(season, days=None, sort='games'):
+    """The leaderboard as a list of dicts, best first by `sort`. Results are cached until
+    the collector writes new stats."""
+    global _cache_version
+    if sort not in SORT_KEYS:
+        sort = 'games'
+    if days is not None:
+        days = min(days, MAX_DAYS)
+    key = (season, days, sort)
+    version = get_data_version()
+    with _cache_lock:
+        if version != _cache_version:
+            _cache.clear()
+            _cache_version = version
+        if key in _cache:
+            return _cache[key]
+
+    board = compute_leaderboard(season, days)
+    if not board.empty:
+        board = board.sort_values(sort, ascending=False, na_position='last')
+    board = board.reset_index()
+    # missing values -> None, so they show up empty and not as 'nan'
+    rows = board.astype(object).where(board.notna(), None).to_dict('records')
+
+    with _cache_lock:
+        if version == _cache_version:
+            _cache[key] = rows
+    return rows
@@ -0,0 +1,262 @@
+import bisect
+import copy
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import requests
+
+
+PUSHGATEWAY_URL = os.environ.get('OWSTATS_PUSHGATEWAY')  # e.g. http://localhost:9091, the collector pushes there
+PUSH_JOB = os.environ.get('OWSTATS_PUSH_JOB', 'owstats_collector')
+# set when several processes serve the web app (gunicorn.conf.py does), /metrics adds up all of theirs
+METRICS_DIR = os.environ.get('OWSTATS_METRICS_DIR')
+SAVE_INTERVAL = 1   # seconds between saves of a process's metrics to METRICS_DIR
+ARCHIVE = 'archive.json'    # counters and histograms of processes that exited
+
+# seconds, from a fast API call or DB commit up to a long sweep
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+_metrics = []
+
+
+class Metric:
+    """A metric in the Prometheus text format, with a value per combination of labels.
+    Kept per process: the collector pushes its own, the web app serves its own at /metrics,
+    or with METRICS_DIR set, those of all its worker processes together."""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}    # label values -> value
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def snapshot(self):
+        with self.lock:
+            return copy.deepcopy(self.values)
+
+    def merge(self, values, other):
+        """Adds another process's values into `values`."""
+        for key, value in other.items():
+            values[key] = values[key] + value if key in values else value
+
+    def samples(self, values=None):
+        values = self.snapshot() if values is None else values
+        return [(self.name + self._labels(key), value) for key, value in sorted(values.items())]
+
+    def render(self, values=None):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines += [f'{name} {_format(value)}' for name, value in self.samples(values)]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def merge(self, values, other):
+        values.update(other)    # the most recently saved process wins
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0.0]    # bucket counts, count, sum
+            counts, _, _ = entry = self.values[key]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(counts):
+                counts[i] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def merge(self, values, other):
+        for key, (counts, count, total) in other.items():
+            if key in values:
+                old_counts, old_count, old_total = values[key]
+                counts = [a + b for a, b in zip(old_counts, counts)]
+                count, total = old_count + count, old_total + total
+            values[key] = [counts, count, total]
+
+    def samples(self, values=None):
+        values = self.snapshot() if values is None else values
+        samples = []
+        for key, (counts, count, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket' + self._labels(key, [('le', _format(bound))]), cumulative))
+            samples.append((self.name + '_bucket' + self._labels(key, [('le', '+Inf')]), count))
+            samples.append((self.name + '_count' + self._labels(key), count))
+            samples.append((self.name + '_sum' + self._labels(key), total))
+        return samples
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _render(values=None):
+    return '\n'.join(metric.render(values[metric.name] if values else None) for metric in _metrics) + '\n'
+
+
+def render_metrics():
+    """All metrics in the Prometheus text format: this process's, or with METRICS_DIR set,
+    those of all processes that saved theirs there, added up."""
+    if not METRICS_DIR:
+        return _render()
+    save_metrics(force=True)
+    values = {metric.name: {} for metric in _metrics}
+    with _metrics_dir_lock(shared=True):
+        # oldest first, so the newest gauges win
+        for path in sorted(glob.glob(os.path.join(METRICS_DIR, '*.json')), key=os.path.getmtime):
+            saved = _load(path)
+            for metric in _metrics:
+                metric.merge(values[metric.name], saved.get(metric.name, {}))
+    return _render(values)
+
+
+_saved = {'pid': None, 'path': None, 'time': 0}
+
+
+def save_metrics(force=False):
+    """Saves this process's metrics to METRICS_DIR for render_metrics() in the other
+    processes, at most every SAVE_INTERVAL seconds unless forced."""
+    if not METRICS_DIR:
+        return
+    if _saved['pid'] != os.getpid():
+        # a new worker process, forked from the one that imported this module
+        path = os.path.join(METRICS_DIR, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.json')
+        _saved.update(pid=os.getpid(), path=path, time=0)
+    now = time.monotonic()
+    if not force and now - _saved['time'] < SAVE_INTERVAL:
+        return
+    _saved['time'] = now
+    _dump(_saved['path'], {metric.name: metric.snapshot() for metric in _metrics})
+
+
+def archive_metrics():
+    """When a process exits, adds its counters and histograms to the archive, so the totals
+    don't drop, and removes its file. Its gauges go with it."""
+    if not METRICS_DIR or _saved['pid'] != os.getpid():
+        return
+    archive = os.path.join(METRICS_DIR, ARCHIVE)
+    with _metrics_dir_lock():
+        values = _load(archive)
+        for metric in _metrics:
+            if metric.type != 'gauge':
+                metric.merge(values.setdefault(metric.name, {}), metric.snapshot())
+        _dump(archive, values)
+        try:
+            os.remove(_saved['path'])
+        except FileNotFoundError:
+            pass
+    _saved['pid'] = None
+
+
+def clear_metrics_dir():
+    """Starts the metrics from zero, e.g. when the server (re)starts."""
+    if METRICS_DIR:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+            os.remove(path)
+
+
+@contextmanager
+def _metrics_dir_lock(shared=False):
+    import fcntl    # POSIX only, like the servers that run several processes
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+
+def _dump(path, values):
+    # JSON has no tuple keys, label values are saved as lists
+    data = {name: [[list(key), value] for key, value in metric_values.items()]
+            for name, metric_values in values.items()}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)   # readers see the old file or the new one, never half of one
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {name: {tuple(key): value for key, value in items} for name, items in data.items()}
+
+
+def push_metrics(url=PUSHGATEWAY_URL, job=PUSH_JOB):
+    """Sends this process's metrics to a Prometheus Pushgateway, replacing what the job
+    pushed last time. Does nothing if no Pushgateway is configured."""
+    if not url:
+        return
+    response = requests.put(f"{url.rstrip('/')}/metrics/job/{job}", data=_render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4'}, timeout=10)
+    response.raise_for_status()
+
+
+api_request_seconds = Histogram('owstats_api_request_seconds', 'Time to get a profile from the API, retries included')
+api_responses = Counter('owstats_api_responses_total', 'API responses by HTTP status, "error" if there was none',
+                        ['status'])
+sweep_players = Counter('owstats_sweep_players_total',
+                        'Players in collector sweeps by result: new_stats, unchanged, failed or skipped', ['result'])
+last_sweep_players = Gauge('owstats_last_sweep_players', 'Players in the last sweep by result', ['result'])
+sweep_seconds = Histogram('owstats_sweep_seconds', 'Duration of collector sweeps')
+last_sweep_seconds = Gauge('owstats_last_sweep_seconds', 'Duration of the last sweep')
+last_sweep_timestamp = Gauge('owstats_last_sweep_timestamp_seconds', 'When the last sweep finished, unix time')
+db_commit_seconds = Histogram('owstats_db_commit_seconds', 'Time to write a batch of stats in one transaction')
+plot_render_seconds = Histogram('owstats_plot_render_seconds', 'Time to render a plot in a worker process')
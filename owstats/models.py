@@ -1,12 +1,15 @@
+import json
 from datetime import datetime
 
+from sqlalchemy.ext.declarative import declared_attr
+
 from owstats import db
 
 
 class Season(db.Model):
     __tablename__ = 'seasons'
     id = db.Column(db.Integer, primary_key=True)
-    season = db.Column(db.Integer)
+    season = db.Column(db.Integer, index=True, unique=True)
     next_switch_date = db.Column(db.DateTime, nullable=True)  # find out online
     ctime = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     etime = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -17,6 +20,9 @@ class Season(db.Model):
 
 class Player(db.Model):
     __tablename__ = 'players'
+    __table_args__ = (
+        db.Index('ix_players_active_etime', 'active', 'etime'),
+    )
     id = db.Column(db.Integer, primary_key=True)
 
     # platform 	The game platform (pc, etc)
@@ -26,7 +32,7 @@ class Player(db.Model):
     battletag = db.Column(db.String(20), unique=False, nullable=True)
 
     # battletag doesn't seem to work for psn at the moment
-    username = db.Column(db.String(20), unique=False, nullable=False)
+    username = db.Column(db.String(20), unique=False, nullable=False, index=True)
     region = db.Column(db.String(10), unique=False, nullable=False)
     platform = db.Column(db.String(10), unique=False, nullable=False)
 
@@ -36,6 +42,9 @@ class Player(db.Model):
 
     games_played = db.Column(db.Integer, default=0)
 
+    # snapshot_hash() of the newest comp_stats row, a profile with the same stats isn't logged again
+    stats_hash = db.Column(db.String(40), nullable=True)
+
     comp_stats = db.relationship('CompStats',
                                  backref='player', 
                                  lazy=True, 
@@ -44,14 +53,34 @@ class Player(db.Model):
 
     active = db.Column(db.Integer, default=1) # 0 if inactive, 1 if active
 
+    # validators of the last profile fetched from the API, to skip unchanged profiles
+    api_etag = db.Column(db.String(200), nullable=True)
+    api_last_modified = db.Column(db.String(50), nullable=True)
+    api_hash = db.Column(db.String(40), nullable=True)
+
+    # when the collector polls this player next, and the current interval between polls (seconds)
+    next_poll = db.Column(db.DateTime, nullable=True, index=True)
+    poll_interval = db.Column(db.Integer, nullable=True)
+
+    # failed polls in a row, the collector backs off from the player until next_poll
+    error_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # which collector daemon is polling the player, and until when its claim holds
+    claimed_by = db.Column(db.String(100), nullable=True)
+    claimed_until = db.Column(db.DateTime, nullable=True)
+
     ctime = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     etime = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return '<User %r>' % self.username
 
+    def get_latest_stats(self):
+        # just the newest row, without loading the whole comp_stats history
+        return CompStats.query.filter_by(player_id=self.id).order_by(CompStats.ctime.desc()).first()
+
     def get_win_percentage(self):
-        latest_stats = self.comp_stats[0]
+        latest_stats = self.get_latest_stats()
         games_played = latest_stats.games_played
         games_won = latest_stats.games_won
         if games_played == 0:
@@ -61,10 +90,26 @@ class Player(db.Model):
     def get_seasons(self):
         return db.session.query(CompStats.season).distinct()
 
+    @classmethod
+    def is_due(cls):
+        # players that failed are skipped until their backoff is over
+        return db.or_(cls.error_count == 0, cls.next_poll.is_(None), cls.next_poll <= datetime.utcnow())
+
+    @classmethod
+    def query_by_status(cls, *statuses):
+        # one query for all the lists: active first, then inactive, private and error,
+        # most recently updated first within each
+        order = db.case({1: 0, 2: 1, 3: 2, 0: 3}, value=cls.active)
+        return cls.query.filter(cls.active.in_(statuses)).order_by(order, cls.etime.desc())
+
 
 
 class CompStats(db.Model):
     __tablename__ = 'comp_stats'
+    __table_args__ = (
+        db.Index('ix_comp_stats_player_id_ctime', 'player_id', 'ctime'),
+        db.Index('ix_comp_stats_player_id_season_ctime', 'player_id', 'season', 'ctime'),
+    )
     id = db.Column(db.Integer, primary_key=True)
 
     player_id = db.Column(db.Integer, db.ForeignKey('players.id'), nullable=False)
@@ -81,5 +126,140 @@ class CompStats(db.Model):
 
     season = db.Column(db.Integer)
 
+    # snapshot_hash() of the row, NULL for rows logged before snapshots were hashed
+    content_hash = db.Column(db.String(40), nullable=True)
+
     def __repr__(self):
         return f'<CompStats games: {self.games_played}, open: {self.rating_avg}, tank: {self.rating_tank}, dps: {self.rating_damage}, support: {self.rating_support}>'
+
+
+class ProfileHistory(db.Model):
+    """A player's icon and endorsement over time, a row per change. Each row holds from
+    valid_from until valid_to, which is NULL for the current one. The player row keeps
+    the current values too, for the pages."""
+    __tablename__ = 'profile_history'
+    __table_args__ = (
+        db.Index('ix_profile_history_player_id_valid_to', 'player_id', 'valid_to'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('players.id'), nullable=False)
+    icon = db.Column(db.String(200), nullable=True)
+    endorsement = db.Column(db.Integer)
+    valid_from = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    valid_to = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<ProfileHistory endorsement: {self.endorsement}, from: {self.valid_from:%Y-%m-%d %H:%M}>'
+
+
+class ImportJob(db.Model):
+    """A bulk import of players started from the web app. It's kept in the DB, so any web
+    worker can report on it, and resume it if the worker running it went away."""
+    __tablename__ = 'import_jobs'
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')     # queued, running, finished or failed
+    total = db.Column(db.Integer, nullable=False)
+    rows = db.Column(db.Text, nullable=False)   # the players to import, JSON
+    results = db.Column(db.Text, nullable=False, default='[]')  # a result per row done so far, JSON
+
+    # which worker is running the import, and until when, unless it saves its progress again
+    claimed_by = db.Column(db.String(100), nullable=True)
+    claimed_until = db.Column(db.DateTime, nullable=True)
+
+    ctime = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    etime = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<ImportJob {self.id} {self.status}>'
+
+    def to_dict(self):
+        results = json.loads(self.results)
+        counts = {}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        return {
+            'id': self.id,
+            'status': self.status,
+            'total': self.total,
+            'done': len(results),
+            'counts': counts,
+            'results': sorted(results, key=lambda result: result['row']),
+            'ctime': self.ctime.isoformat(),
+            'etime': self.etime.isoformat() if self.etime else None,
+        }
+
+
+class DataVersion(db.Model):
+    """A counter that's bumped when rows that are already there change, which caches
+    keyed on the newest row id wouldn't notice, e.g. rows moved by retag-seasons."""
+    __tablename__ = 'data_versions'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DataVersion {self.name}: {self.version}>'
+
+
+class RollupMixin:
+    """Columns shared by the rollup tables, one row per player and period summarizing
+    the CompStats rows logged in it. Kept up to date by owstats.rollups as rows are written."""
+    id = db.Column(db.Integer, primary_key=True)
+
+    @declared_attr
+    def player_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('players.id'), nullable=False)
+
+    season = db.Column(db.Integer, nullable=False)
+
+    # games_played/games_won are the totals at the end of the period, *_start at its first row
+    games_start = db.Column(db.Integer)
+    games_played = db.Column(db.Integer)
+    wins_start = db.Column(db.Integer)
+    games_won = db.Column(db.Integer)
+
+    rating_avg_last = db.Column(db.Integer)
+    rating_tank_first = db.Column(db.Integer)
+    rating_tank_min = db.Column(db.Integer)
+    rating_tank_max = db.Column(db.Integer)
+    rating_tank_last = db.Column(db.Integer)
+    rating_damage_first = db.Column(db.Integer)
+    rating_damage_min = db.Column(db.Integer)
+    rating_damage_max = db.Column(db.Integer)
+    rating_damage_last = db.Column(db.Integer)
+    rating_support_first = db.Column(db.Integer)
+    rating_support_min = db.Column(db.Integer)
+    rating_support_max = db.Column(db.Integer)
+    rating_support_last = db.Column(db.Integer)
+
+    snapshots = db.Column(db.Integer, nullable=False, default=0)   # CompStats rows in the period
+    first_ctime = db.Column(db.DateTime, nullable=False)
+    last_ctime = db.Column(db.DateTime, nullable=False)
+
+    def get_games(self):
+        return self.games_played - self.games_start
+
+    def get_wins(self):
+        return self.games_won - self.wins_start
+
+
+class DailyStats(RollupMixin, db.Model):
+    __tablename__ = 'daily_stats'
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'season', 'day'),
+    )
+    day = db.Column(db.Date, nullable=False)
+
+
+class WeeklyStats(RollupMixin, db.Model):
+    __tablename__ = 'weekly_stats'
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'season', 'week'),
+    )
+    week = db.Column(db.Date, nullable=False)   # the Monday the week starts on
+
+
+class SeasonStats(RollupMixin, db.Model):
+    __tablename__ = 'season_stats'
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'season'),
+    )
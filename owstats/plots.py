@@ -0,0 +1,176 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from owstats import CompStats, Player, db, metrics
+from owstats.utils import PLOT_DIR, get_plot_path, make_plot
+
+
+PLOT_WORKERS = int(os.environ.get('OWSTATS_PLOT_WORKERS', 2))  # processes rendering plots
+PLOT_CACHE_SIZE = int(os.environ.get('OWSTATS_PLOT_CACHE_MB', 200)) * 1024 * 1024  # max size of PLOT_DIR
+
+
+def get_high_water_mark(player_id, season):
+    # a new row changes the newest id and the count, and rows moved in or out of the
+    # season by retag-seasons change the count
+    max_id, count = db.session.query(db.func.max(CompStats.id), db.func.count(CompStats.id)) \
+        .filter_by(player_id=player_id, season=season).one()
+    return f'{max_id}:{count}'
+
+
+def render_plot(player_id, season):
+    """Renders the player's plot for the season, unless no CompStats rows were logged
+    since the last time it was rendered. Returns True if the plot was rendered."""
+    player = Player.query.get(player_id)
+    plot_path = get_plot_path(player, season)
+    mark = get_high_water_mark(player_id, season)
+
+    if os.path.exists(plot_path) and _read_mark(plot_path) == mark:
+        return False
+
+    make_plot(player, season)
+    with open(plot_path + '.mark', 'w') as f:
+        f.write(mark)
+    return True
+
+
+def _read_mark(plot_path):
+    try:
+        with open(plot_path + '.mark') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def is_plot_current(player, season):
+    plot_path = get_plot_path(player, season)
+    return os.path.exists(plot_path) and _read_mark(plot_path) == get_high_water_mark(player.id, season)
+
+
+def get_plot_image(player, season, timeout=60):
+    """Returns the PNG of the player's season plot, rendering it first if it's missing
+    or out of date."""
+    plot_path = get_plot_path(player, season)
+    for _ in range(2):
+        if not is_plot_current(player, season):
+            get_plot_queue().submit(player.id, season).result(timeout=timeout)
+        try:
+            with open(plot_path, 'rb') as f:
+                image = f.read()
+            os.utime(plot_path)     # recently used, keep it in the cache
+            return image
+        except FileNotFoundError:
+            pass    # evicted by someone else before we got to read it, render it again
+    raise FileNotFoundError(plot_path)
+
+
+def evict_plots(max_size=PLOT_CACHE_SIZE):
+    """Deletes the least recently used plots until PLOT_DIR fits in max_size bytes.
+    Serving a plot touches its file, so mtime is the last time it was used."""
+    plots = []
+    total = 0
+    with os.scandir(PLOT_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith('.png'):
+                stat = entry.stat()
+                plots.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+    for _, size, path in sorted(plots):
+        if total <= max_size:
+            break
+        for fn in (path, path + '.mark'):
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def _render_in_worker(player_id, season):
+    # (rendered, seconds), metrics don't leave the worker process so the time goes back with the result
+    start = time.perf_counter()
+    try:
+        return render_plot(player_id, season), time.perf_counter() - start
+    finally:
+        db.session.remove()
+
+
+def _render_batch_item(key):
+    try:
+        return _render_in_worker(*key)
+    except Exception:
+        logging.exception(f'Plot for player {key[0]}, season {key[1]} failed')
+        return False, 0
+
+
+def render_plots(keys, workers=None):
+    """Renders many (player id, season) plots in a pool of worker processes, one per
+    core by default, e.g. everyone's plots after a season rollover. Plots that are
+    already up to date are skipped. Returns the number of plots rendered."""
+    keys = list(keys)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        rendered = 0
+        for was_rendered, seconds in executor.map(_render_batch_item, keys, chunksize=16):
+            if was_rendered:
+                rendered += 1
+                metrics.plot_render_seconds.observe(seconds)
+    evict_plots()
+    return rendered
+
+
+class PlotQueue:
+    """Renders plots in worker processes, so neither the collector nor a web request
+    waits on matplotlib. A request for a (player, season) that is already waiting in
+    the queue is coalesced with it instead of rendering the plot twice."""
+
+    def __init__(self, workers=PLOT_WORKERS):
+        # spawned, not forked: workers open their own DB connections instead of sharing ours
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        self.pending = {}   # (player id, season) -> future
+        self.lock = threading.Lock()
+
+    def submit(self, player_id, season):
+        key = (player_id, season)
+        with self.lock:
+            future = self.pending.get(key)
+            # a render that has already started might miss the newest rows, so only join a waiting one
+            if future is not None and not future.running() and not future.done():
+                return future
+            future = self.executor.submit(_render_in_worker, player_id, season)
+            self.pending[key] = future
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def _done(self, key, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logging.error(f'Plot for player {key[0]}, season {key[1]} failed', exc_info=future.exception())
+        else:
+            rendered, seconds = future.result()
+            if rendered:
+                metrics.plot_render_seconds.observe(seconds)
+                evict_plots()   # keep PLOT_DIR within PLOT_CACHE_SIZE, whoever queued the plot
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_plot_queue = None
+_plot_queue_lock = threading.Lock()
+
+
+def get_plot_queue():
+    global _plot_queue
+    with _plot_queue_lock:
+        if _plot_queue is None:
+            _plot_queue = PlotQueue()
+        return _plot_queue
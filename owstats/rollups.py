@@ -0,0 +1,168 @@
+import logging
+from datetime import timedelta
+
+from sqlalchemy import bindparam
+
+from owstats import CompStats, DailyStats, DataVersion, SeasonStats, WeeklyStats, db
+from owstats.ingest import ROLES
+
+
+# rollup model, its period column and how to get the period from a row's ctime
+ROLLUPS = [
+    (DailyStats, 'day', lambda ctime: ctime.date()),
+    (WeeklyStats, 'week', lambda ctime: ctime.date() - timedelta(days=ctime.weekday())),
+    (SeasonStats, None, None),
+]
+
+ROLLUP_BATCH = 5000     # comp_stats rows per transaction when rebuilding
+REBUILD_CHUNK = 500     # players per rebuild when only some players' rollups are rebuilt
+STATS_VERSION = 'stats'     # DataVersion row of comp_stats and the rollups
+
+
+def stats_row(cs):
+    return {column.name: getattr(cs, column.name) for column in CompStats.__table__.columns}
+
+
+def _merge(rollup, row):
+    if rollup is None:
+        rollup = {
+            'player_id': row['player_id'],
+            'season': row['season'],
+            'games_start': row['games_played'],
+            'wins_start': row['games_won'],
+            'snapshots': 0,
+            'first_ctime': row['ctime'],
+        }
+        for role in ROLES:
+            rollup[f'rating_{role}_first'] = rollup[f'rating_{role}_min'] = rollup[f'rating_{role}_max'] = None
+
+    rollup['snapshots'] += 1
+    rollup['games_played'] = row['games_played']
+    rollup['games_won'] = row['games_won']
+    rollup['rating_avg_last'] = row['rating_avg']
+    rollup['last_ctime'] = row['ctime']
+    for role in ROLES:
+        level = row[f'rating_{role}']
+        rollup[f'rating_{role}_last'] = level
+        if level is not None:
+            if rollup[f'rating_{role}_first'] is None:
+                rollup[f'rating_{role}_first'] = level
+            low, high = rollup[f'rating_{role}_min'], rollup[f'rating_{role}_max']
+            rollup[f'rating_{role}_min'] = level if low is None else min(low, level)
+            rollup[f'rating_{role}_max'] = level if high is None else max(high, level)
+    return rollup
+
+
+def update_rollups(conn, rows):
+    """Folds newly inserted comp_stats rows (dicts, ctime included) into the daily, weekly
+    and season rollups, in the caller's transaction. Rows have to be newer than what's
+    already rolled up, which holds for rows the collector logs. Rows moved to another
+    season need a rebuild_rollups."""
+    if not rows:
+        return
+    rows = sorted(rows, key=lambda row: row['ctime'])
+    player_ids = {row['player_id'] for row in rows}
+    seasons = {row['season'] for row in rows}
+
+    for model, period, period_of in ROLLUPS:
+        table = model.__table__
+
+        # load the rollups these rows fall into, in one query per table
+        query = table.select().where(table.c.player_id.in_(player_ids), table.c.season.in_(seasons))
+        if period:
+            query = query.where(table.c[period].in_({period_of(row['ctime']) for row in rows}))
+        existing = {}
+        for rollup in conn.execute(query).mappings():
+            k = (rollup['player_id'], rollup['season']) + ((rollup[period],) if period else ())
+            existing[k] = dict(rollup)
+
+        merged = {}
+        for row in rows:
+            k = (row['player_id'], row['season']) + ((period_of(row['ctime']),) if period else ())
+            rollup = _merge(merged.get(k, existing.get(k)), row)
+            if period:
+                rollup[period] = k[2]
+            merged[k] = rollup
+
+        inserts = [rollup for k, rollup in merged.items() if k not in existing]
+        updates = [dict(rollup, _id=rollup.pop('id')) for k, rollup in merged.items() if k in existing]
+        if inserts:
+            conn.execute(table.insert(), inserts)
+        if updates:
+            conn.execute(table.update().where(table.c.id == bindparam('_id')), updates)
+
+
+def rebuild_rollups(player_ids=None):
+    """Recreates the rollups of all players, or only of `player_ids`, from comp_stats, e.g.
+    to backfill history logged before the rollup tables existed or after rows were moved
+    to another season. Rows are streamed in batches, so memory use stays flat."""
+    if player_ids is None:
+        return _rebuild_rollups(None)
+    player_ids = sorted(player_ids)
+    return sum(_rebuild_rollups(player_ids[i:i + REBUILD_CHUNK])
+               for i in range(0, len(player_ids), REBUILD_CHUNK))
+
+
+def _rebuild_rollups(player_ids):
+    with db.engine.begin() as conn:
+        for model, _, _ in ROLLUPS:
+            delete = model.__table__.delete()
+            if player_ids is not None:
+                delete = delete.where(model.__table__.c.player_id.in_(player_ids))
+            conn.execute(delete)
+
+    # walk comp_stats by id, which is also the order the rows were logged in
+    table = CompStats.__table__
+    count = 0
+    last_id = 0
+    while True:
+        query = table.select().where(table.c.id > last_id).order_by(table.c.id).limit(ROLLUP_BATCH)
+        if player_ids is not None:
+            query = query.where(table.c.player_id.in_(player_ids))
+        with db.engine.begin() as conn:
+            rows = [dict(row) for row in conn.execute(query).mappings()]
+            if not rows:
+                break
+            update_rollups(conn, rows)
+        last_id = rows[-1]['id']
+        count += len(rows)
+        logging.info(f'Rolled up {count} rows')
+    with db.engine.begin() as conn:
+        bump_stats_version(conn)
+    return count
+
+
+def bump_stats_version(conn):
+    """Bumps the stats data version, for changes to comp_stats or rollup rows that are
+    already there (the leaderboard cache only notices new rows on its own)."""
+    table = DataVersion.__table__
+    bumped = conn.execute(table.update().where(table.c.name == STATS_VERSION)
+                          .values(version=table.c.version + 1)).rowcount
+    if not bumped:
+        conn.execute(table.insert().values(name=STATS_VERSION, version=1))
+
+
+def get_stats_version():
+    return db.session.query(DataVersion.version).filter_by(name=STATS_VERSION).scalar()
+
+
+def get_rollup_model(period):
+    for model, name, _ in ROLLUPS:
+        if name == period:
+            return model
+    raise ValueError(f'Unknown rollup period: {period}')
+
+
+def get_season_series(player, season, max_points=200):
+    """(games played, tank, damage, support) points of the player's season for a chart.
+    Raw rows if there are at most max_points of them, otherwise the daily rollup, and
+    the weekly one if even that has too many points, so long seasons stay cheap to read."""
+    raw_count = CompStats.query.filter_by(player_id=player.id, season=season).count()
+    if raw_count <= max_points:
+        rows = CompStats.query.filter_by(player_id=player.id, season=season).order_by(CompStats.ctime)
+        return [(r.games_played, r.rating_tank, r.rating_damage, r.rating_support) for r in rows]
+
+    for model in (DailyStats, WeeklyStats):
+        rows = model.query.filter_by(player_id=player.id, season=season).order_by(model.first_ctime)
+        if model is WeeklyStats or rows.count() <= max_points:
+            return [(r.games_played, r.rating_tank_last, r.rating_damage_last, r.rating_support_last) for r in rows]
@@ -0,0 +1,87 @@
+import heapq
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam
+
+from owstats import Player, db
+
+
+MIN_POLL_INTERVAL = 60 * int(os.environ.get('OWSTATS_MIN_POLL_MINUTES', 30))  # players who are playing
+MAX_POLL_INTERVAL = 60 * int(os.environ.get('OWSTATS_MAX_POLL_MINUTES', 7 * 24 * 60))  # idle ones
+POLL_JITTER = 0.1   # +-10% on every interval, so players polled together drift apart
+RELOAD_INTERVAL = 10 * 60   # seconds between reloads of the schedule from the DB
+
+
+def next_poll_after(player, changed):
+    """When to poll the player next, and the interval that was used."""
+    if changed or not player.poll_interval:
+        interval = MIN_POLL_INTERVAL
+    else:
+        interval = min(player.poll_interval * 2, MAX_POLL_INTERVAL)
+    next_poll = datetime.utcnow() + timedelta(seconds=interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER))
+    return next_poll, interval
+
+
+class PollScheduler:
+    """Decides when each player is polled next.
+
+    A player who got a new CompStats row is polled again after MIN_POLL_INTERVAL.
+    Each poll that finds nothing new doubles the interval, up to MAX_POLL_INTERVAL.
+    The next poll time and the interval are stored on the player (next_poll,
+    poll_interval), so the schedule survives restarts. Here they're kept in a heap,
+    which is reloaded from the DB every RELOAD_INTERVAL to pick up new players.
+    Players that were never scheduled get a next_poll on the first reload that sees them.
+    """
+
+    def __init__(self):
+        self.heap = []      # (next poll, player id)
+        self.loaded = None
+
+    def reload(self, force=False):
+        if not force and self.loaded is not None and time.monotonic() - self.loaded < RELOAD_INTERVAL:
+            return
+        now = datetime.utcnow()
+        rows = db.session.query(Player.id, Player.next_poll).all()
+
+        # players that were never scheduled are spread evenly over the next minimum interval,
+        # and their slots are saved, so the next reload doesn't spread them out again
+        unscheduled = [player_id for player_id, next_poll in rows if next_poll is None]
+        step = MIN_POLL_INTERVAL / max(len(unscheduled), 1)
+        slots = [(now + timedelta(seconds=i * step), player_id) for i, player_id in enumerate(unscheduled)]
+        if slots:
+            players = Player.__table__
+            with db.engine.begin() as conn:
+                conn.execute(players.update()
+                             .where(players.c.id == bindparam('_id'), players.c.next_poll.is_(None))
+                             .values(etime=players.c.etime),
+                             [{'_id': player_id, 'next_poll': next_poll} for next_poll, player_id in slots])
+        self.heap = slots + [(next_poll, player_id) for player_id, next_poll in rows if next_poll is not None]
+        heapq.heapify(self.heap)
+        self.loaded = time.monotonic()
+
+    def pop_due(self, limit):
+        now = datetime.utcnow()
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < limit:
+            due.append(heapq.heappop(self.heap)[1])
+        return due
+
+    def seconds_until_next(self):
+        if not self.heap:
+            return MIN_POLL_INTERVAL
+        return max((self.heap[0][0] - datetime.utcnow()).total_seconds(), 0)
+
+    def push(self, player_id, next_poll):
+        heapq.heappush(self.heap, (next_poll, player_id))
+
+    def reschedule(self, player, changed):
+        """Puts the player back in the queue, returns the new next_poll and poll_interval to save."""
+        next_poll, interval = next_poll_after(player, changed)
+        self.push(player.id, next_poll)
+        return next_poll, interval
+
+    def release(self, player_ids):
+        pass    # nothing to give back, the heap is only this process's
@@ -0,0 +1,92 @@
+import logging
+from datetime import timezone
+
+from sqlalchemy.exc import IntegrityError
+
+from owstats import CompStats, Season, db
+from owstats.rollups import bump_stats_version
+from owstats.utils import is_it_new_season
+
+
+def latest_season():
+    return Season.query.order_by(Season.etime.desc()).first()
+
+
+def roll_over_season():
+    """Starts the next season if the current one's next_switch_date has passed, and
+    returns the season to log stats in. Runs once at the start of a sweep, so every
+    player in a sweep gets the same season.
+
+    Collectors starting a sweep at the same time may all try to create the season; the
+    unique index on seasons.season lets one of them do it, the others use that one.
+    """
+    current = latest_season()
+    if current is None or not is_it_new_season(current.next_switch_date):
+        return current
+
+    new_season = Season(season=current.season + 1)
+    db.session.add(new_season)
+    try:
+        db.session.commit()
+        logging.info(f'New season created: {new_season}')
+        return new_season
+    except IntegrityError:
+        db.session.rollback()
+        logging.info(f'Season {current.season + 1} was created by another collector')
+        return Season.query.filter_by(season=current.season + 1).one()
+
+
+def _to_utc(local):
+    # next_switch_date is local time (see is_it_new_season), ctime is UTC
+    return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def season_starts():
+    """(season, start) of every season, oldest first. A season starts at the previous
+    season's next_switch_date, or when its row was created if that wasn't set. The
+    first one has no start."""
+    seasons = Season.query.filter(Season.season.isnot(None)).order_by(Season.season).all()
+    starts = []
+    for previous, season in zip([None] + seasons, seasons):
+        if previous is None:
+            start = None
+        elif previous.next_switch_date:
+            start = _to_utc(previous.next_switch_date)
+        else:
+            start = season.ctime
+        starts.append((season.season, start))
+    return starts
+
+
+def retag_seasons():
+    """Moves comp_stats rows that were logged in a season but tagged with an earlier one
+    into the season they were logged in. Before seasons rolled over at the start of a
+    sweep, rows logged after the switch date kept the old season until some player's
+    games played dropped.
+
+    Returns the number of rows moved and the (player id, season) pairs they were moved
+    from and to, whose rollups and plots are out of date now.
+    """
+    table = CompStats.__table__
+    starts = season_starts()
+    known = [season for season, _ in starts]
+    moved = 0
+    changed = set()
+    with db.engine.begin() as conn:
+        for (season, start), (_, end) in zip(starts, starts[1:] + [(None, None)]):
+            where = [table.c.season < season, table.c.season.in_(known)]
+            if start is not None:
+                where.append(table.c.ctime >= start)
+            if end is not None:
+                where.append(table.c.ctime < end)
+            pairs = conn.execute(db.select([table.c.player_id, table.c.season]).where(*where).distinct()).all()
+            if not pairs:
+                continue
+            result = conn.execute(table.update().where(*where).values(season=season))
+            logging.info(f'Moved {result.rowcount} rows to season {season}')
+            moved += result.rowcount
+            for player_id, old_season in pairs:
+                changed.update([(player_id, old_season), (player_id, season)])
+        if moved:
+            bump_stats_version(conn)
+    return moved, changed
@@ -1,34 +1,158 @@
+import hashlib
 import os
+import threading
+import time
+from collections import deque
 from datetime import date, datetime
+from urllib.parse import urlparse
 
-import matplotlib.pyplot as plt
-import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from owstats import CompStats, Player
+from owstats import CompStats, Season, db, metrics
+from owstats.rollups import get_rollup_model, get_season_series
 
 
-BASE_URL = 'https://ow-api.com/v1/stats'
+BASE_URL = os.environ.get('OWSTATS_API_URL', 'https://ow-api.com/v1/stats')  # e.g. bench/fake_api.py
+API_RATE_LIMIT = float(os.environ.get('OWSTATS_API_RATE', 5))  # max requests per second per host, 0 = no limit
+API_TIMEOUT = (float(os.environ.get('OWSTATS_API_CONNECT_TIMEOUT', 5)),  # seconds to connect
+               float(os.environ.get('OWSTATS_API_READ_TIMEOUT', 30)))    # seconds to wait for the response
+API_RETRIES = int(os.environ.get('OWSTATS_API_RETRIES', 3))
+API_BACKOFF = float(os.environ.get('OWSTATS_API_BACKOFF', 1))  # retries wait 1s, 2s, 4s, ...
+API_POOL_SIZE = int(os.environ.get('OWSTATS_API_POOL_SIZE', 10))  # keep >= OWSTATS_WORKERS
+BREAKER_THRESHOLD = float(os.environ.get('OWSTATS_BREAKER_THRESHOLD', 0.5))  # failed share of calls that stops a sweep
+BREAKER_MIN_CALLS = int(os.environ.get('OWSTATS_BREAKER_MIN_CALLS', 20))
+BREAKER_WINDOW = int(os.environ.get('OWSTATS_BREAKER_WINDOW', 100))  # latest calls the failed share is taken over
 
-def get_api_response(platform, region, username):
+PLOT_DIR = os.path.join(os.path.dirname(__file__), 'static/plots')
+SEASON_CACHE_TTL = int(os.environ.get('OWSTATS_SEASON_CACHE_TTL', 300))  # seconds
+STATS_PER_PAGE = 100
+
+# lowest SR of every rank, charts draw a line at each
+RANKS = [(0, 'Bronze'), (1500, 'Silver'), (2000, 'Gold'), (2500, 'Platinum'), (3000, 'Diamond'),
+         (3500, 'Master'), (4000, 'Grandmaster')]
+
+
+def make_session():
+    # 429 and 503 responses are retried after their Retry-After header, everything else
+    # in status_forcelist (and connection errors) with exponential backoff
+    retry = Retry(total=API_RETRIES,
+                  backoff_factor=API_BACKOFF,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET'],
+                  respect_retry_after_header=True,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        "User-Agent": "OWstats",
+        "Accept": "application/json",
+    })
+    return session
+
+
+# shared by the collector and the web app, so connections to the API are kept alive and reused
+session = make_session()
+
+
+class RateLimiter:
+    """Spaces out calls so no more than `rate` of them start each second, across all threads."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class CircuitBreaker:
+    """Counts the successes and failures of the latest `window` calls and opens once enough
+    calls were made and too many of them failed, e.g. when the API is down, instead of on
+    the first error. It's kept across sweeps, so the small batches of the scheduled modes
+    add up; reset() it once the collector has backed off."""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, min_calls=BREAKER_MIN_CALLS, window=BREAKER_WINDOW):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.results = deque(maxlen=max(window, min_calls))
+
+    def record(self, success):
+        self.results.append(success)
+
+    def is_open(self):
+        calls = len(self.results)
+        return calls >= self.min_calls and self.results.count(False) / calls >= self.threshold
+
+    def reset(self):
+        self.results.clear()
+
+
+class ApiError(Exception):
+    """The API answered, but with an error instead of a profile."""
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(host):
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = RateLimiter(API_RATE_LIMIT)
+        return _rate_limiters[host]
+
+
+def get_api_response(platform, region, username, etag=None, last_modified=None):
     url = f'{BASE_URL}/{platform}/{region}/{username}/profile'
 
-    response = requests.get(url,
-                        headers={
-                            "Host": "ow-api.com",
-                            "User-Agent": "PythonTest 0.2",
-                            "DNT": "1",
-                            "Connection": "keep-alive",
-                            "Cookie": "__cfduid=df6937f525b58b9a98ac7d59a94d2c4761590714472",
-                            "Upgrade-Insecure-Requests": '1',
-                            "Cache-Control": "max-age=0",
-                            "Accept" : "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8"
-                        }
-                        )
+    # conditional request if we have validators from the last time, the API answers 304 if nothing changed
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    get_rate_limiter(urlparse(url).netloc).wait()
+    start = time.perf_counter()
+    try:
+        response = session.get(url, timeout=API_TIMEOUT, headers=headers)
+    except Exception:
+        metrics.api_responses.inc(status='error')
+        raise
+    finally:
+        metrics.api_request_seconds.observe(time.perf_counter() - start)
+    metrics.api_responses.inc(status=response.status_code)
 
     return response
 
 
+def fetch_profile(platform, region, username, etag=None, last_modified=None, content_hash=None):
+    """Fetches the profile using the validators saved from the last fetch.
+
+    Returns (response, content hash, changed). The body is only hashed, not parsed,
+    so an unchanged profile costs no JSON parsing, whether the API answered 304 or
+    sent the same body again.
+    """
+    response = get_api_response(platform, region, username, etag, last_modified)
+    if response.status_code == 304:
+        return response, content_hash, False
+    new_hash = hashlib.sha1(response.content).hexdigest()
+    return response, new_hash, new_hash != content_hash
+
+
 def check_if_more_than_seven_days(d):
     now = datetime.now()                
     return (now - d).days > 7
@@ -45,23 +169,37 @@ def is_it_new_season(next_switch_date):
     return next_switch_date < now
 
 
+def get_plot_path(user, season):
+    plot_fn = f"{user.username}_{user.platform}_{user.region}_{season}.png"
+    os.makedirs(PLOT_DIR, exist_ok=True)
+    return os.path.join(PLOT_DIR, plot_fn)
+
+
 def make_plot(user, season=0):
+    # matplotlib and pandas take longer to import than the rest of the app together,
+    # so they're only loaded by the processes that actually render plots
+    import matplotlib
+    matplotlib.use('Agg')   # render to files, never look for a display
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    import pandas as pd
+
     data = {'Games played': [],
         'Tank SR': [],
         'Damage SR': [],
         'Support SR': []
        }
-    ranks = [1500, 2000, 2500, 3000, 3500, 4000]
+    ranks = [sr for sr, _ in RANKS if sr]
     
     if season == 0:
-        season = user.comp_stats[0].season
-
-    for stat in user.comp_stats:
-        if stat.season == season:
-            data['Games played'].append(stat.games_played)
-            data['Tank SR'].append(stat.rating_tank)
-            data['Damage SR'].append(stat.rating_damage)
-            data['Support SR'].append(stat.rating_support)
+        season = user.get_latest_stats().season
+
+    # only this season, from a rollup if it has too many rows to plot one by one
+    for games_played, tank, damage, support in get_season_series(user, season):
+        data['Games played'].append(games_played)
+        data['Tank SR'].append(tank)
+        data['Damage SR'].append(damage)
+        data['Support SR'].append(support)
     
     # find min and max SR on chart
     allSR = data['Tank SR'] + data['Damage SR'] + data['Support SR']
@@ -71,31 +209,58 @@ def make_plot(user, season=0):
             res.append(val)
 
     df = pd.DataFrame(data,columns=['Games played','Tank SR','Damage SR','Support SR'])
-    
-    plt.plot(df['Games played'], df['Tank SR'], '.:b', label='Tank SR')
-    plt.plot(df['Games played'], df['Damage SR'], '*:r', label='Damage SR')
-    plt.plot(df['Games played'], df['Support SR'], '^:c', label='Support SR')
-    plt.title(f'Season {season}: SR changes per role', loc = 'left')
-    plt.xlabel('Games played')
-    plt.ylabel('SR')
-    plt.legend()
-    plt.grid(axis = 'y')
+
+    # a Figure of our own instead of pyplot's global one, so plots can be made
+    # from several threads at once and a failed plot can't leak into the next one
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.plot(df['Games played'], df['Tank SR'], '.:b', label='Tank SR')
+    ax.plot(df['Games played'], df['Damage SR'], '*:r', label='Damage SR')
+    ax.plot(df['Games played'], df['Support SR'], '^:c', label='Support SR')
+    ax.set_title(f'Season {season}: SR changes per role', loc = 'left')
+    ax.set_xlabel('Games played')
+    ax.set_ylabel('SR')
+    ax.legend()
+    ax.grid(axis = 'y')
     if res:
         minSR = min(res)
         maxSR = max(res)
         for rank in ranks:
             if rank + 50 > minSR and rank - 50 < maxSR:
-                plt.axhline(y=rank, color='r', linestyle='-')
-    # plt.show()
-    plot_fn = f"{user.username}_{user.platform}_{user.region}_{season}.png"
-    plot_dir = os.path.dirname(__loader__.path)
-    plot_path = os.path.join(plot_dir, 'static/plots', plot_fn)
-    plt.savefig(plot_path, dpi=100)
-    plt.clf()
+                ax.axhline(y=rank, color='r', linestyle='-')
+
+    # write to a temp file first, so nobody reads a half written plot
+    plot_path = get_plot_path(user, season)
+    tmp_path = f'{plot_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    fig.savefig(tmp_path, dpi=100, format='png')
+    os.replace(tmp_path, plot_path)
+
+
+def get_player_seasons(player):
+    seasons = db.session.query(CompStats.season).filter_by(player_id=player.id) \
+        .distinct().order_by(CompStats.season.desc())
+    return [season for season, in seasons]
+
+
+def get_player_season_stats(player, season, page=1, per_page=STATS_PER_PAGE, period=None):
+    # a page of the player's rows for one season, newest first, or of a rollup by day/week
+    model = get_rollup_model(period) if period else CompStats
+    order = model.last_ctime if period else CompStats.ctime
+    return model.query.filter_by(player_id=player.id, season=season) \
+        .order_by(order.desc()) \
+        .paginate(page=page, per_page=per_page, error_out=False)
+
+
+_current_season = (0, None)   # (expiry time, season number)
 
 
-def get_player_seasons(username):
-    seasons = []
-    for season in CompStats.query.join(Player).filter_by(username=username).distinct(CompStats.season).order_by(CompStats.season.desc()):
-        seasons.append(season.season)
-    return seasons
+def get_current_season():
+    """Number of the current season. It's looked up on almost every page but only
+    changes a few times a year, so it's cached for SEASON_CACHE_TTL seconds."""
+    global _current_season
+    expires, season = _current_season
+    if season is None or time.monotonic() > expires:
+        season = Season.query.order_by(Season.etime.desc()).first().season
+        _current_season = (time.monotonic() + SEASON_CACHE_TTL, season)
+    return season
@@ -0,0 +1,78 @@
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+from owstats import Player, db
+from owstats.scheduler import MIN_POLL_INTERVAL, next_poll_after
+
+
+CLAIM_LEASE = 60 * int(os.environ.get('OWSTATS_CLAIM_LEASE_MINUTES', 30))  # before a claim of a dead collector expires
+
+
+class WorkQueue:
+    """The players table as a queue shared by any number of collector daemons.
+
+    A daemon claims a batch of due players (next_poll has passed, nobody else holds
+    them) by writing its claim token and a lease into claimed_by and claimed_until,
+    polls them, saves their next_poll and releases them. On Postgres the batch is
+    picked with SELECT ... FOR UPDATE SKIP LOCKED, so daemons claiming at the same
+    time get different players without waiting on each other. SQLite has no row
+    locks, but the whole claim is a single UPDATE, which SQLite runs one at a time.
+
+    If a daemon dies, its players are free again once the lease runs out.
+    It's used in place of a PollScheduler, with the same methods.
+    """
+
+    def __init__(self, lease=CLAIM_LEASE):
+        self.lease = lease
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    def reload(self, force=False):
+        pass    # the schedule is read from the DB on every claim
+
+    def pop_due(self, limit):
+        """Claims up to `limit` due players, most overdue first, returns their ids."""
+        now = datetime.utcnow()
+        token = f'{self.worker}:{uuid.uuid4().hex[:8]}'
+        players = Player.__table__
+        due = db.select([players.c.id]) \
+            .where(db.or_(players.c.next_poll.is_(None), players.c.next_poll <= now)) \
+            .where(db.or_(players.c.claimed_until.is_(None), players.c.claimed_until < now)) \
+            .order_by(players.c.next_poll.is_(None).desc(), players.c.next_poll) \
+            .limit(limit) \
+            .with_for_update(skip_locked=True)
+        with db.engine.begin() as conn:
+            conn.execute(players.update()
+                         .where(players.c.id.in_(due.scalar_subquery()))
+                         .values(claimed_by=token, claimed_until=now + timedelta(seconds=self.lease),
+                                 etime=players.c.etime))   # a claim isn't a change to the player
+            return [player_id for player_id, in conn.execute(
+                db.select([players.c.id]).where(players.c.claimed_by == token))]
+
+    def release(self, player_ids):
+        """Gives the players back, whether they were polled or not."""
+        if not player_ids:
+            return
+        players = Player.__table__
+        with db.engine.begin() as conn:
+            conn.execute(players.update()
+                         .where(players.c.id.in_(player_ids), players.c.claimed_by.like(f'{self.worker}:%'))
+                         .values(claimed_by=None, claimed_until=None, etime=players.c.etime))
+
+    def seconds_until_next(self):
+        now = datetime.utcnow()
+        unscheduled, next_poll = db.session.query(
+            db.func.sum(db.case([(Player.next_poll.is_(None), 1)], else_=0)), db.func.min(Player.next_poll)) \
+            .filter(Player.claimed_until.is_(None) | (Player.claimed_until < now)).one()
+        if unscheduled:
+            return 0
+        if next_poll is None:
+            return MIN_POLL_INTERVAL
+        return max((next_poll - now).total_seconds(), 0)
+
+    def push(self, player_id, next_poll):
+        pass    # next_poll is saved on the player, which is all the queue needs
+
+    def reschedule(self, player, changed):
+        return next_poll_after(player, changed)
@@ -0,0 +1,107 @@
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import SQLAlchemyError
+
+from owstats import CompStats, Player, ProfileHistory, db, metrics
+from owstats.jsonapi import invalidate_players
+from owstats.rollups import update_rollups
+
+
+BATCH_SIZE = int(os.environ.get('OWSTATS_BATCH_SIZE', 200))  # players written per transaction
+SCHEDULE_COLUMNS = {'next_poll', 'poll_interval', 'error_count'}   # updating only these doesn't touch etime
+
+
+class StatsWriter:
+    """Buffers the collector's CompStats inserts, Player updates and ProfileHistory
+    changes and writes them in batches with executemany, one transaction per batch.
+    Player values that are the same as on the loaded player aren't written at all.
+
+    If a batch fails it is written again one player per transaction, so a bad row
+    only loses that player's changes. The writes go through their own connection,
+    which keeps the ORM session (and the players loaded in it) from being expired
+    on every commit.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.pending = {}   # player id -> (player, [comp_stats rows], {player columns}, {profile_history row})
+
+    def _entry(self, player):
+        if player.id not in self.pending:
+            self.pending[player.id] = (player, [], {}, {})
+        return self.pending[player.id]
+
+    def add_stats(self, player, **values):
+        values.setdefault('ctime', datetime.utcnow())   # the rollups need it before the insert
+        self._entry(player)[1].append(dict(values, player_id=player.id))
+
+    def update_player(self, player, **values):
+        pending = self.pending[player.id][2] if player.id in self.pending else {}
+        values = {name: value for name, value in values.items() if pending.get(name, getattr(player, name)) != value}
+        if values:
+            self._entry(player)[2].update(values)
+
+    def change_profile(self, player, **values):
+        """Starts a new ProfileHistory row with these values, ending the current one."""
+        values.setdefault('valid_from', datetime.utcnow())
+        self._entry(player)[3].update(values, player_id=player.id)
+        self.update_player(player, **{name: value for name, value in values.items() if name != 'valid_from'})
+
+    def is_full(self):
+        return len(self.pending) >= self.batch_size
+
+    def flush(self):
+        """Write everything pending, returns the players that were written."""
+        if not self.pending:
+            return []
+        entries = list(self.pending.values())
+        self.pending = {}
+
+        try:
+            with metrics.db_commit_seconds.time(), db.engine.begin() as conn:
+                self._write(conn, entries)
+            written = entries
+        except SQLAlchemyError:
+            logging.exception(f'Batch of {len(entries)} players failed, writing them one by one')
+            written = []
+            for entry in entries:
+                try:
+                    with db.engine.begin() as conn:
+                        self._write(conn, [entry])
+                    written.append(entry)
+                except SQLAlchemyError:
+                    logging.exception(f'Could not write stats for {entry[0]}')
+
+        # cached API responses of players with new stats are out of date now
+        invalidate_players([player.username for player, rows, _, _ in written if rows])
+        return [player for player, _, _, _ in written]
+
+    def _write(self, conn, entries):
+        stats = [row for _, rows, _, _ in entries for row in rows]
+        if stats:
+            conn.execute(CompStats.__table__.insert(), stats)
+            update_rollups(conn, stats)
+
+        # executemany needs the same columns in every row, so group the updates by columns
+        updates = {}
+        for player, _, values, _ in entries:
+            if values:
+                updates.setdefault(tuple(sorted(values)), []).append(dict(values, _id=player.id))
+        players = Player.__table__
+        for columns, rows in updates.items():
+            update = players.update().where(players.c.id == bindparam('_id'))
+            if SCHEDULE_COLUMNS.issuperset(columns):
+                update = update.values(etime=players.c.etime)   # keep etime for when the profile last changed
+            conn.execute(update, rows)
+
+        changes = [change for _, _, _, change in entries if change]
+        if changes:
+            history = ProfileHistory.__table__
+            conn.execute(history.update()
+                         .where(history.c.player_id == bindparam('_id'), history.c.valid_to.is_(None))
+                         .values(valid_to=bindparam('_valid_to')),
+                         [{'_id': change['player_id'], '_valid_to': change['valid_from']} for change in changes])
+            conn.execute(history.insert(), changes)